@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf8:et:sta:ai:sw=4:ts=4:sts=4
+"""compare the boundary-scanning multipart parser with the line-based one
+
+usage: python benchmarks/multipart_bench.py [megabytes]
+"""
+
+import os
+import random
+import sys
+import time
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from routing import multipart
+
+
+BOUNDARY = "----------bench-boundary"
+
+def build_body(fields):
+    out = []
+    for name, filename, data in fields:
+        disposition = 'form-data; name="%s"' % name
+        if filename:
+            disposition += '; filename="%s"' % filename
+        out.append("--%s\r\nContent-Disposition: %s\r\n"
+                "Content-Type: application/octet-stream\r\n\r\n%s\r\n"
+                % (BOUNDARY, disposition, data))
+    out.append("--%s--\r\n" % BOUNDARY)
+    return ''.join(out)
+
+def binary_body(size):
+    # newline-heavy binary data is the worst case for a line-based parser
+    rand = random.Random(0)
+    block = ''.join(rand.choice('\r\n\x00abc') for i in xrange(65536))
+    data = (block * (size // len(block) + 1))[:size]
+    return build_body([("upload", "data.bin", data)])
+
+def small_fields_body(size):
+    fields = []
+    total = 0
+    while total < size:
+        value = "value-%d" % len(fields)
+        fields.append(("field%d" % len(fields), None, value))
+        total += len(value) + 100
+    return build_body(fields)
+
+def run(parser_class, body, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        for part in parser_class(StringIO(body), BOUNDARY, len(body),
+                mem_limit=2**31, disk_limit=2**31):
+            pass
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(argv):
+    megabytes = int(argv[1]) if len(argv) > 1 else 16
+    bodies = [
+        ("large binary", binary_body(megabytes * 2**20)),
+        ("small fields", small_fields_body(megabytes * 2**18)),
+    ]
+    parsers = [
+        ("boundary scan", multipart.MultipartParser),
+        ("line based", multipart.LineMultipartParser),
+    ]
+    for label, body in bodies:
+        mb = len(body) / float(2**20)
+        for name, parser_class in parsers:
+            elapsed = run(parser_class, body, 3)
+            print "%-14s %-15s %8.1f MB/s" % (label, name, mb / elapsed)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf8:et:sta:ai:sw=4:ts=4:sts=4
+"""microbenchmarks for the request data structures
+
+compares the slotted MultiDict and the environ-backed header view with the
+MutableMapping-based MultiDict and copied header dict they replaced. reports
+time per request and the number of gc-tracked objects each one leaves alive.
+
+usage: python benchmarks/structures_bench.py
+"""
+
+import cgi
+import collections
+import gc
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import routing
+from routing import multipart
+
+
+class LegacyMultiDict(collections.MutableMapping):
+    "the MultiDict as it was, for comparison"
+    def __init__(self, *a, **k):
+        self.dict = dict()
+        for k, v in dict(*a, **k).iteritems():
+            self[k] = v
+
+    def __len__(self): return len(self.dict)
+    def __iter__(self): return iter(self.dict)
+    def __contains__(self, key): return key in self.dict
+    def __delitem__(self, key): del self.dict[key]
+    def keys(self): return self.dict.keys()
+    def __getitem__(self, key): return self.get(key, KeyError, -1)
+    def __setitem__(self, key, value): self.append(key, value)
+    def append(self, key, value): self.dict.setdefault(key, []).append(value)
+    def get(self, key, default=None, index=-1):
+        if key not in self.dict and default != KeyError:
+            return [default][index]
+        return self.dict[key][index]
+
+
+ENVIRON = dict(('HTTP_X_HEADER_%d' % i, 'value %d' % i) for i in xrange(30))
+ENVIRON.update({
+    'HTTP_HOST': 'example.com',
+    'HTTP_ACCEPT_ENCODING': 'gzip, deflate',
+    'HTTP_USER_AGENT': 'Mozilla/5.0 (X11; Linux x86_64) benchmark',
+    'REQUEST_METHOD': 'GET',
+    'PATH_INFO': '/',
+    'QUERY_STRING': '&'.join('p%d=v%d' % (i % 20, i) for i in xrange(30)),
+})
+QUERY = cgi.parse_qsl(ENVIRON['QUERY_STRING'], keep_blank_values=True)
+
+
+def legacy_headers():
+    headers = LegacyMultiDict([(k[5:].replace('_', '-'), v.lstrip(' '))
+            for k, v in ENVIRON.iteritems() if k.startswith("HTTP_")])
+    return headers, headers.get('HOST'), headers.get('ACCEPT-ENCODING')
+
+def view_headers():
+    headers = routing.EnvironHeaders(ENVIRON)
+    return headers, headers.get('Host'), headers.get('Accept-Encoding')
+
+def legacy_query():
+    return LegacyMultiDict(QUERY)
+
+def slotted_query():
+    return multipart.MultiDict(QUERY)
+
+
+def live_objects(func, count=1000):
+    gc.collect()
+    before = len(gc.get_objects())
+    keep = [func() for i in xrange(count)]
+    gc.collect()
+    after = len(gc.get_objects())
+    del keep
+    return (after - before - 1) / float(count)
+
+def main():
+    cases = [
+        ("headers", "copied MultiDict", legacy_headers),
+        ("headers", "EnvironHeaders", view_headers),
+        ("query", "MutableMapping MultiDict", legacy_query),
+        ("query", "slotted MultiDict", slotted_query),
+    ]
+    for group, label, func in cases:
+        best = min(timeit.repeat(func, number=10000, repeat=3))
+        print "%-8s %-26s %8.2f us %8.1f objects" % (
+                group, label, best / 10000 * 1e6, live_objects(func))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf8:et:sta:ai:sw=4:ts=4:sts=4
+"""benchmarks for routing's hot paths, run in-process through App.__call__
+
+usage: python benchmarks/suite.py [-o results.json] [-c baseline.json]
+                                  [-t seconds] [-k name-filter]
+
+every benchmark reports requests/sec, and MB/s for the ones that move a
+request or response body. results can be saved as JSON and compared against
+an earlier run.
+"""
+
+import json
+import optparse
+import os
+import platform
+import sys
+import time
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import routing
+import multipart_bench
+
+
+def make_environ(path, method='GET', query='', headers=None, body='',
+        content_type=None):
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'SCRIPT_NAME': '',
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(body),
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    if content_type:
+        environ['CONTENT_TYPE'] = content_type
+    for name, value in (headers or {}).iteritems():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    return environ
+
+def start_response(status, headers):
+    pass
+
+def drive(app, environ):
+    "run one request; environ is copied and its body rewound every time"
+    environ = dict(environ)
+    environ['wsgi.input'] = StringIO(environ['wsgi.input'].getvalue())
+    size = 0
+    for chunk in app(environ, start_response):
+        size += len(chunk)
+    return size
+
+
+BENCHMARKS = []
+
+def benchmark(name, body_bytes=0):
+    "register a factory that returns (app, environ) for a benchmark"
+    def register(func):
+        BENCHMARKS.append((name, body_bytes, func))
+        return func
+    return register
+
+
+def route_app(count):
+    app = routing.App()
+    for i in xrange(count):
+        app.get(r"^/section%d/(\w+)/$" % i)(lambda http, arg: arg)
+    return app
+
+for count in (10, 100, 1000):
+    for where, index in (('early', 0), ('late', count - 1)):
+        benchmark('resolve.%d.%s' % (count, where))(
+            lambda count=count, index=index: (
+                route_app(count),
+                make_environ('/section%d/item/' % index)))
+    benchmark('resolve.%d.404' % count)(
+        lambda count=count: (route_app(count), make_environ('/missing/')))
+
+
+def request_app():
+    app = routing.App()
+    @app.get("^/request/$")
+    def touch_everything(http):
+        http.headers.get('USER-AGENT')
+        http.GET.get('q')
+        http.COOKIES.get('session')
+        return ''
+    @app.get("^/bare/$")
+    def touch_nothing(http):
+        return ''
+    return app
+
+def busy_request(path):
+    headers = dict(('X-Header-%d' % i, 'value %d' % i) for i in xrange(30))
+    headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64) benchmark'
+    headers['Cookie'] = '; '.join(
+            'cookie%d=value%d' % (i, i) for i in xrange(30))
+    query = '&'.join('param%d=value%d' % (i, i) for i in xrange(30))
+    return make_environ(path, query=query, headers=headers)
+
+benchmark('request.parsed')(
+        lambda: (request_app(), busy_request('/request/')))
+benchmark('request.untouched')(
+        lambda: (request_app(), busy_request('/bare/')))
+
+
+def form_app():
+    app = routing.App()
+    @app.post("^/form/$")
+    def form(http):
+        http.POST
+        http.FILES
+        return ''
+    return app
+
+def multipart_environ(body):
+    return make_environ('/form/', 'POST', body=body,
+            content_type='multipart/form-data; boundary=%s'
+                % multipart_bench.BOUNDARY)
+
+SMALL_FIELDS = multipart_bench.small_fields_body(2**16)
+LARGE_BINARY = multipart_bench.binary_body(2**22)
+URLENCODED = '&'.join('field%d=some+value+%%26+more%d' % (i, i)
+        for i in xrange(500))
+
+benchmark('multipart.small_fields', len(SMALL_FIELDS))(
+        lambda: (form_app(), multipart_environ(SMALL_FIELDS)))
+benchmark('multipart.large_binary', len(LARGE_BINARY))(
+        lambda: (form_app(), multipart_environ(LARGE_BINARY)))
+benchmark('urlencoded', len(URLENCODED))(
+        lambda: (form_app(), make_environ('/form/', 'POST', body=URLENCODED,
+            content_type='application/x-www-form-urlencoded')))
+
+
+def chunked_app():
+    app = routing.App()
+    fragment = '<li>item</li>\n'
+    @app.get("^/chunked/$")
+    @app.chunked
+    def many_fragments(http):
+        for i in xrange(1000):
+            yield fragment
+    @app.get("^/coalesced/$")
+    @app.chunked(min_size=8192)
+    def coalesced_fragments(http):
+        for i in xrange(1000):
+            yield fragment
+    return app
+
+benchmark('chunked.fragments', 14000)(
+        lambda: (chunked_app(), make_environ('/chunked/')))
+benchmark('chunked.coalesced', 14000)(
+        lambda: (chunked_app(), make_environ('/coalesced/')))
+
+
+JSON_RECORDS = [{'id': i, 'name': 'item %d' % i, 'tags': ['a', 'b']}
+        for i in xrange(1000)]
+
+def json_app():
+    app = routing.App()
+    @app.get("^/json/$")
+    @app.json
+    def records(http):
+        return iter(JSON_RECORDS)
+    return app
+
+benchmark('json.stream', len(json.dumps(JSON_RECORDS, separators=(',', ':'))))(
+        lambda: (json_app(), make_environ('/json/')))
+
+
+def run_one(factory, seconds):
+    app, environ = factory()
+    drive(app, environ) # warm up
+    count, start = 0, time.time()
+    deadline = start + seconds
+    batch = 1
+    while 1:
+        for i in xrange(batch):
+            drive(app, environ)
+        count += batch
+        now = time.time()
+        if now >= deadline:
+            break
+        batch = min(batch * 2, 1000)
+    return count, now - start
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n\n')[1])
+    parser.add_option('-o', '--output', help='write results to this JSON file')
+    parser.add_option('-c', '--compare', help='compare with this JSON file')
+    parser.add_option('-t', '--time', type='float', default=1.0,
+            help='seconds to spend on each benchmark')
+    parser.add_option('-k', '--filter', default='',
+            help='only run benchmarks with this in their name')
+    options, args = parser.parse_args(argv[1:])
+
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as fp:
+            baseline = json.load(fp)['results']
+
+    results = {}
+    for name, body_bytes, factory in BENCHMARKS:
+        if options.filter not in name:
+            continue
+        count, elapsed = run_one(factory, options.time)
+        rps = count / elapsed
+        result = {'requests': count, 'seconds': elapsed, 'rps': rps}
+        line = "%-28s %12.1f req/s" % (name, rps)
+        if body_bytes:
+            result['mbps'] = rps * body_bytes / 2.0**20
+            line += " %10.1f MB/s" % result['mbps']
+        if name in baseline:
+            line += "  (%+.1f%%)" % (
+                    100.0 * (rps - baseline[name]['rps']) / baseline[name]['rps'])
+        results[name] = result
+        print line
+        sys.stdout.flush()
+
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.time(),
+                'results': results,
+            }, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
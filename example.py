@@ -85,10 +85,7 @@ def on_failure(http, triple):
             + ''.join(traceback.format_exception(*triple)))
 
 subapp = App()
-
-@app.get("^/subapp")
-def delegate_to_subapp(http):
-    return subapp
+app.mount("/subapp", subapp)
 
 @subapp.get("/$")
 def subapp_index(http):
@@ -4,48 +4,189 @@ import BaseHTTPServer
 import cgi
 import collections
 import Cookie
+import copy
+import email.utils
+import hashlib
 import itertools
+import os
 import re
+import stat
 import sys
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
+import threading
+import time
+import urllib
+import warnings
 
-from . import multipart
+from . import caching, compress, dispatch, files, jsonstream, metrics, \
+        multipart, offload, sse, urls
 
 
-__all__ = ["App", "Error"]
+__all__ = ["App", "Error", "FLUSH", "FileResponse", "RouteWarning"]
+
+FileResponse = files.FileResponse
 
 RESPONSES = BaseHTTPServer.BaseHTTPRequestHandler.responses
 NOT_SUPPLIED = object()
 
+# yield this from a chunked handler to send everything buffered so far
+FLUSH = object()
+
+# what App.metadata handlers return for HEAD requests, in place of a body
+_NO_BODY = object()
+
+
+class RouteWarning(UserWarning):
+    "issued by App.freeze for routes that others hide"
+
+
+class lazy_property(object):
+    "a property computed on first access and cached on the instance"
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.__name__] = self.func(obj)
+        return value
+
+
+_environ_keys = {}
+
+def _environ_key(name):
+    try:
+        return _environ_keys[name]
+    except KeyError:
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        if len(_environ_keys) < 1024:
+            _environ_keys[name] = key
+        return key
+
+class EnvironHeaders(object):
+    '''a read-only, case-insensitive view of the request headers in environ
+
+    nothing is copied: lookups go straight to the environ. header names are
+    reported the way they used to be stored, upper-cased with dashes.
+    '''
+    __slots__ = ['environ']
+
+    def __init__(self, environ):
+        self.environ = environ
+
+    def __getitem__(self, name):
+        return self.environ[_environ_key(name)].lstrip(' ')
+
+    def __contains__(self, name):
+        return _environ_key(name) in self.environ
+
+    def __iter__(self):
+        for key in self.environ:
+            if key.startswith('HTTP_'):
+                yield key[5:].replace('_', '-')
+            elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                yield key.replace('_', '-')
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def get(self, name, default=None):
+        value = self.environ.get(_environ_key(name))
+        if value is None:
+            return default
+        return value.lstrip(' ')
+
+    def getall(self, name):
+        value = self.get(name)
+        return [] if value is None else [value]
+
+    def keys(self): return list(self)
+    def iterkeys(self): return iter(self)
+    def values(self): return [self[name] for name in self]
+    def items(self): return [(name, self[name]) for name in self]
+    def iteritems(self): return ((name, self[name]) for name in self)
+    iterallitems = iteritems
+
 
 class HTTP(object):
+    # set this (or App.upload_sink) before touching POST or FILES to stream
+    # multipart uploads somewhere, see multipart.MultipartParser's `sink`
+    upload_sink = None
+
+    # likewise for the directory that large multipart parts are spooled to
+    # (see multipart.MultipartPart.mmap), None is the system's temp directory
+    spool_dir = None
+
+    # limits on multipart bodies (see multipart.MultipartParser): fields
+    # buffered in memory, and uploads written to files. set them here or on
+    # the App. uploads handed to a callable upload_sink count against neither
+    upload_mem_limit = 2**20
+    upload_disk_limit = 2**30
+
+    # a compress.Compression (or None to disable) for just this response,
+    # NOT_SUPPLIED falls back to the app's setting
+    compression = NOT_SUPPLIED
+
+    # whether to tag and revalidate just this response (see App.conditional),
+    # NOT_SUPPLIED falls back to the app's setting
+    conditional = NOT_SUPPLIED
+
+    # limits on urlencoded POST bodies; exceeding them is a 413
+    form_mem_limit = 2**20
+    form_max_fields = 1000
+    form_max_field_size = 2**16
+
     def __init__(self, environ):
         self.environ = environ
-        self.COOKIES = ChangeDetectingCookie(environ.get('HTTP_COOKIE', ''))
         self.PATH = environ['PATH_INFO']
         self.METHOD = environ['REQUEST_METHOD'].upper()
 
         self._out_headers = []
         self._out_code = 200
 
-        headerlist = [
-                (k[5:].replace('_', '-'), v.lstrip(' '))
-                for k, v in environ.iteritems()
-                if k.startswith("HTTP_")]
-        self.headers = multipart.MultiDict(headerlist)
+    # everything parsed out of the request is deferred until first use, so
+    # handlers only pay for the parts of the request they actually look at
 
+    @lazy_property
+    def COOKIES(self):
+        return ChangeDetectingCookie(self.environ.get('HTTP_COOKIE', ''))
+
+    @lazy_property
+    def headers(self):
+        return EnvironHeaders(self.environ)
+
+    @lazy_property
+    def GET(self):
         get_params = cgi.parse_qsl(
-                environ.get('QUERY_STRING', ''), keep_blank_values=True)
+                self.environ.get('QUERY_STRING', ''), keep_blank_values=True)
+        return multipart.MultiDict(get_params)
+
+    @lazy_property
+    def POST(self):
+        self._parse_body()
+        return self.__dict__['POST']
 
-        self.GET = multipart.MultiDict(get_params)
+    # the parts in FILES are closed (and any spooled to disk deleted) once
+    # the response has been sent; save_as() whatever has to outlive it
+    @lazy_property
+    def FILES(self):
+        self._parse_body()
+        return self.__dict__['FILES']
+
+    @lazy_property
+    def BODY(self):
+        return self.environ['wsgi.input']
+
+    def _parse_body(self):
+        # fills in both POST and FILES, as they come from the same body
         self.POST = multipart.MultiDict()
         self.FILES = multipart.MultiDict()
-        self.BODY = environ['wsgi.input']
+        environ = self.environ
 
-        if environ['REQUEST_METHOD'].upper() not in ('POST', 'PUT'):
+        if self.METHOD not in ('POST', 'PUT'):
             return
 
         content_length = environ.get('CONTENT_LENGTH', '')
@@ -63,7 +204,9 @@ class HTTP(object):
             if not bound:
                 return
             parser = multipart.MultipartParser(environ['wsgi.input'], bound,
-                    content_length, charset=charset)
+                    content_length, charset=charset, sink=self.upload_sink,
+                    spool_dir=self.spool_dir, mem_limit=self.upload_mem_limit,
+                    disk_limit=self.upload_disk_limit)
             for part in parser:
                 if part.filename or not part.is_buffered():
                     self.FILES[part.name] = part
@@ -71,18 +214,18 @@ class HTTP(object):
                     self.POST[part.name] = part.value
         elif content_type in ('application/x-www-form-urlencoded',
                 'application/x-url-encoded'):
-            data = StringIO()
-            chunk = environ['wsgi.input'].read(8192)
-            total = len(chunk)
-            while chunk:
-                data.write(chunk)
-                chunk = environ['wsgi.input'].read(8192)
-                total += len(chunk)
-            if total < content_length:
+            parser = multipart.UrlencodedParser(environ['wsgi.input'],
+                    content_length, mem_limit=self.form_mem_limit,
+                    max_fields=self.form_max_fields,
+                    max_field_size=self.form_max_field_size)
+            try:
+                pairs = list(parser)
+            except multipart.MultipartError, exc:
+                raise Error(413, str(exc))
+            if parser.bytes_read < content_length:
                 # if we got an incomplete body, don't provide *any* body
                 return
-            self.POST = multipart.MultiDict(
-                    cgi.parse_qsl(data.getvalue(), keep_blank_values=True))
+            self.POST = multipart.MultiDict(pairs)
 
     @property
     def url(self):
@@ -100,7 +243,7 @@ class HTTP(object):
         scheme = self.environ['wsgi.url_scheme']
 
         if 'HOST' in self.headers:
-            host = self.headers['HOST'][0]
+            host = self.headers['HOST']
         else:
             host = self.environ['SERVER_NAME']
             port = self.environ['SERVER_PORT']
@@ -120,15 +263,157 @@ class HTTP(object):
         raise Error(code, '')
 
 
+class ChunkedBody(object):
+    "the output of a chunked handler, framed only once it's iterated"
+    def __init__(self, source, frame, min_size=0, max_latency=None):
+        self.source = source
+        self.frame = frame
+        self.min_size = min_size
+        self.max_latency = max_latency
+
+    def __iter__(self):
+        return self.frame(self.source, self.min_size, self.max_latency)
+
+
+def _close_files(files):
+    for name, part in files.iterallitems():
+        part.close()
+
+class _ClosingBody(object):
+    # closes the request's uploads once the server is done with the body
+    def __init__(self, body, files):
+        self.body = body
+        self.files = files
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            _close_files(self.files)
+
+
+def _quote_etag(etag):
+    if etag.startswith('"') or etag.startswith('W/"'):
+        return etag
+    return '"%s"' % etag
+
+def _not_modified(http, etag, last_modified):
+    '''check the request's validators against the response's
+
+    `etag` is a quoted entity tag and `last_modified` a unix timestamp,
+    either may be None
+    '''
+    if_none_match = http.headers.get('IF-NONE-MATCH')
+    if if_none_match is not None:
+        # If-Modified-Since is ignored when If-None-Match is present
+        if etag is None:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        # the weak comparison function
+        etag = etag[2:] if etag.startswith('W/') else etag
+        for candidate in if_none_match.split(','):
+            candidate = candidate.strip()
+            if candidate.startswith('W/'):
+                candidate = candidate[2:]
+            if candidate == etag:
+                return True
+        return False
+
+    if_modified_since = http.headers.get('IF-MODIFIED-SINCE')
+    if if_modified_since is not None and last_modified is not None:
+        since = email.utils.parsedate_tz(if_modified_since)
+        if since is not None:
+            return int(last_modified) <= email.utils.mktime_tz(since)
+    return False
+
+def _if_range(if_range, etag, last_modified):
+    # whether a Range request's If-Range (if any) still holds
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    date = email.utils.parsedate_tz(if_range)
+    return date is not None and \
+            email.utils.mktime_tz(date) == int(last_modified)
+
+def _prime(iterable):
+    # pull the first item so that a generator at least gets entered
+    iterator = iter(iterable)
+    try:
+        prefix = [iterator.next()]
+    except StopIteration:
+        prefix = []
+    return itertools.chain(prefix, iterator)
+
+
 class App(object):
-    def __init__(self):
+    def __init__(self, resolve_cache_size=0, compression=None, etags=False,
+            response_cache_bytes=2**26, stats=None):
         self.handlers = collections.defaultdict(list)
+        self.routers = collections.defaultdict(dispatch.Router)
+        # (method, path) -> resolved handler, for apps with hot paths
+        self.resolve_cache = None
+        if resolve_cache_size:
+            self.resolve_cache = dispatch.LRUCache(resolve_cache_size)
         self.handler_404 = None
         self.handler_500 = None
+        self.upload_sink = None
+        self.spool_dir = None
+        # None leaves HTTP's defaults
+        self.upload_mem_limit = None
+        self.upload_disk_limit = None
+        self.mounts = {}
+        if compression is True:
+            compression = compress.Compression()
+        self.compression = compression
+        self.etags = etags
+        # the default store for App.cached routes
+        self.response_cache = caching.ResponseCache(response_cache_bytes)
+        # per-route counters and latencies, a metrics.RouteStats when enabled
+        if stats is True:
+            stats = metrics.RouteStats()
+        self.stats = stats
+        self.frozen = False
+        self._freeze_lock = threading.Lock()
+        # the typed segments patterns can use, name -> urls.Converter
+        self.converters = dict(urls.CONVERTERS)
+        # handler -> [(format string, fields)], see url_for
+        self._url_templates = {}
 
     def add_handler(self, method, pattern):
+        '''register a handler for requests matching the regex `pattern`
+
+        patterns may contain typed segments, <converter:name> or just <name>
+        for a string without slashes. they become named groups, and the
+        handler gets them as keyword arguments already converted: <int:id>
+        is an int, <uuid:key> a uuid.UUID and <path:rest> may span slashes.
+        see App.converters for adding more. routes with typed segments and
+        otherwise literal patterns can be reversed with App.url_for.
+        '''
+        if self.frozen:
+            raise RuntimeError("can't add routes to a frozen App")
         def addme(func):
-            self.handlers[method].append((re.compile(pattern), func))
+            source, conversions, pieces = urls.compile_pattern(
+                    pattern, self.converters)
+            regex = re.compile(source)
+            handler = func
+            if conversions:
+                handler = urls.converting(func, conversions)
+            self.handlers[method].append((regex, handler))
+            self.routers[method].add(regex, handler)
+            template = urls.url_template(pieces)
+            if template is not None:
+                templates = self._url_templates.setdefault(func, [])
+                if template not in templates:
+                    templates.append(template)
+            if self.resolve_cache is not None:
+                self.resolve_cache.clear()
             return func
         return addme
 
@@ -138,6 +423,119 @@ class App(object):
     def put(self, pattern): return self.add_handler("PUT", pattern)
     def delete(self, pattern): return self.add_handler("DELETE", pattern)
 
+    def mount(self, prefix, app):
+        '''delegate every request under `prefix` straight to another App
+
+        mounts are checked before any of this app's own routes, and only match
+        on whole path segments ("/api" takes "/api" and "/api/users" but not
+        "/apix"). the mounted app resolves what follows the prefix. a GET or
+        HEAD for the prefix itself is redirected to it with a trailing slash.
+        mounting at "/" hands everything the longer mounts don't take over.
+        '''
+        if self.frozen:
+            raise RuntimeError("can't mount apps on a frozen App")
+        self.mounts[prefix.rstrip('/')] = app
+        return app
+
+    def freeze(self):
+        '''lock the route table and build its dispatch structures up front
+
+        this happens by itself on the first request, but calling it at
+        startup (before forking workers, say) gets it out of the way and
+        reports problems straight away: routes that are hidden by earlier
+        routes or by a mount, found by trying sample paths on each route, are
+        reported with a RouteWarning. mounted apps are frozen as well.
+        registering routes or mounts afterwards raises RuntimeError.
+
+        returns the warning messages, for this app and the mounted ones
+        '''
+        with self._freeze_lock:
+            if self.frozen:
+                return []
+            problems = []
+            for method, router in sorted(self.routers.iteritems()):
+                router.freeze()
+                problems.extend(self._overlaps(method, router))
+            for message in problems:
+                warnings.warn(message, RouteWarning, stacklevel=2)
+            self.frozen = True
+
+        for prefix, app in sorted(self.mounts.iteritems()):
+            problems.extend(app.freeze())
+        return problems
+
+    def _overlaps(self, method, router):
+        def describe(index):
+            if not isinstance(index, int):
+                return index
+            regex, handler = router.routes[index]
+            return "%r (%s)" % (regex.pattern,
+                    getattr(handler, '__name__', handler))
+
+        def mounted(path):
+            found = self._find_mount(path)
+            if found is not None:
+                return "the mount at %r" % (path[:found[0]] or '/')
+            return None
+
+        for index, earlier, unreachable in router.overlaps(
+                mounted if self.mounts else None):
+            yield "%s route %s %s %s" % (method, describe(index),
+                    "is unreachable, hidden by" if unreachable
+                        else "partly overlaps",
+                    ", ".join(describe(other) for other in earlier))
+
+    def url_for(self, handler, **params):
+        '''build the path to a handler's route from its segments' values
+
+        the first route registered for `handler` whose segments are all in
+        `params` is used, and any other params go in the query string.
+        handlers of mounted apps get the mount's prefix. the path is relative
+        to the app's root, it doesn't include the request's SCRIPT_NAME.
+        '''
+        for fmt, fields in self._url_templates.get(handler, ()):
+            try:
+                values = tuple(to_url(params[name]) for name, to_url in fields)
+            except KeyError:
+                continue
+            url = fmt % values
+            if len(params) > len(fields):
+                names = set(name for name, to_url in fields)
+                url += '?' + urllib.urlencode(sorted(
+                    (k, v) for k, v in params.iteritems() if k not in names))
+            return url
+
+        for prefix, app in self.mounts.iteritems():
+            try:
+                return prefix + app.url_for(handler, **params)
+            except LookupError:
+                pass
+        raise LookupError("can't build a URL for %r with %s" % (
+            handler, ', '.join(sorted(params)) or 'no parameters'))
+
+    def _find_mount(self, path):
+        # longest mounted prefix ending on a segment boundary
+        mounts = self.mounts
+        pos = len(path)
+        while pos > 0:
+            app = mounts.get(path[:pos])
+            if app is not None:
+                return pos, app
+            pos = path.rfind('/', 0, pos)
+        app = mounts.get('')
+        if app is not None:
+            return 0, app
+        return None
+
+    def _add_slash(self, environ, start_response):
+        location = urllib.quote(environ.get('SCRIPT_NAME', '')
+                + environ['PATH_INFO']) + '/'
+        if environ.get('QUERY_STRING'):
+            location += '?' + environ['QUERY_STRING']
+        start_response("302 %s" % RESPONSES[302][0],
+                [('Location', location), ('Content-Length', '0')])
+        return ['']
+
     def handle_500(self, func):
         self.handler_500 = func
         return func
@@ -147,13 +545,46 @@ class App(object):
         return func
 
     def __call__(self, environ, start_response):
+        if not self.frozen:
+            self.freeze()
+
+        if self.mounts:
+            path = environ.get('routing.remaining_path', environ['PATH_INFO'])
+            mounted = self._find_mount(path)
+            if mounted is not None:
+                pos, app = mounted
+                if pos and pos == len(path) and environ['REQUEST_METHOD'] \
+                        in ('GET', 'HEAD'):
+                    return self._add_slash(environ, start_response)
+                environ['routing.remaining_path'] = path[pos:]
+                return app(environ, start_response)
+
+        stats = self.stats
+        if stats is not None:
+            started = time.time()
+
         handler, args, kwargs = self._resolve(environ)
 
+        if stats is not None:
+            resolved = time.time()
+            error = False
+
         if 'routing.http' in environ:
             http = environ['routing.http']
         else:
             http = HTTP(environ)
             environ['routing.http'] = http
+        if self.upload_sink is not None and http.upload_sink is None:
+            http.upload_sink = self.upload_sink
+        if self.spool_dir is not None and http.spool_dir is None:
+            http.spool_dir = self.spool_dir
+        # unless the request already has its own
+        if self.upload_mem_limit is not None \
+                and 'upload_mem_limit' not in http.__dict__:
+            http.upload_mem_limit = self.upload_mem_limit
+        if self.upload_disk_limit is not None \
+                and 'upload_disk_limit' not in http.__dict__:
+            http.upload_disk_limit = self.upload_disk_limit
         if handler:
             try:
                 message = handler(http, *args, **kwargs)
@@ -164,7 +595,14 @@ class App(object):
                 if message is None:
                     message = RESPONSES[status][1]
             except Exception:
+                if stats is not None:
+                    error = True
+                    if self.handler_500 is None:
+                        stats.record(environ['routing.route'], 500,
+                                resolved - started, time.time() - resolved, 0)
                 if self.handler_500 is None:
+                    if http.__dict__.get('FILES'):
+                        _close_files(http.FILES)
                     raise
                 http.set_code(500)
                 message = self.handler_500(http, sys.exc_info())
@@ -179,19 +617,28 @@ class App(object):
             environ['routing.http'] = http
             return message(environ, start_response)
 
-        # pull the first chunk so that a generator at least gets entered
-        if hasattr(message, "__iter__"):
-            iterator = iter(message)
-            try:
-                prefix = [iterator.next()]
-            except StopIteration:
-                prefix = []
-            message = itertools.chain(prefix, iterator)
+        # a file's body is handed to the server as-is, so that it can use
+        # wsgi.file_wrapper's fast path
+        direct = isinstance(message, FileResponse)
+        if direct:
+            status, message = self._send_file(http, status, message)
+        elif http.METHOD == 'HEAD':
+            # the body is thrown away below, so don't start generating it
+            pass
+        elif isinstance(message, ChunkedBody):
+            message.source = _prime(message.source)
+        elif hasattr(message, "__iter__"):
+            message = _prime(message)
+
+        status, message = self._revalidate(http, status, message)
+        message = self._compress(http, status, message)
 
-        for value in http.COOKIES.updated():
-            http.add_header('Set-Cookie', str(value.output(header='')))
+        # if the cookies were never parsed, they can't have been changed
+        if 'COOKIES' in http.__dict__:
+            for value in http.COOKIES.updated():
+                http.add_header('Set-Cookie', str(value.output(header='')))
 
-        if (isinstance(message, str)
+        if (isinstance(message, str) and status not in (204, 304)
                 and not any(k.lower() == 'content-length'
                     for k, v in http._out_headers)):
             http.add_header('Content-Length', str(len(message)))
@@ -208,36 +655,505 @@ class App(object):
         if not hasattr(message, "__iter__"):
             message = [message]
 
+        if stats is not None:
+            route = environ['routing.route']
+            handled = time.time()
+            if direct or isinstance(message, list):
+                stats.record(route, status, resolved - started,
+                        handled - resolved, 0, error)
+            else:
+                message = stats.timed_body(message, route, status,
+                        resolved - started, handled - resolved, error)
+
+        if http.__dict__.get('FILES'):
+            message = _ClosingBody(message, http.FILES)
+
         return message
 
     def _resolve(self, environ):
         path = environ.get('routing.remaining_path', environ['PATH_INFO'])
-        for regex, handler in self.handlers[environ['REQUEST_METHOD'].upper()]:
-            match = regex.match(path)
-            if match:
-                environ['routing.remaining_path'] = \
-                        path[:match.start()] + path[match.end():]
-                kwargs = match.groupdict()
-                args = () if kwargs else match.groups()
+        method = environ['REQUEST_METHOD'].upper()
+
+        cache = self.resolve_cache
+        if cache is not None:
+            cached = cache.get((method, path))
+            if cached is not None:
+                handler, args, kwargs, remaining, route = cached
+                environ['routing.remaining_path'] = remaining
+                environ['routing.route'] = route
                 return handler, args, kwargs
+
+        router = self.routers.get(method)
+        found = router and router.match(path)
+        if not found and method == 'HEAD':
+            # HEAD is GET without the body
+            router = self.routers.get('GET')
+            found = router and router.match(path)
+        if found:
+            regex, handler, match = found
+            remaining = path[:match.start()] + path[match.end():]
+            route = (method, regex.pattern)
+            environ['routing.remaining_path'] = remaining
+            environ['routing.route'] = route
+            kwargs = match.groupdict()
+            args = () if kwargs else match.groups()
+            if cache is not None:
+                cache.put((method, path),
+                        (handler, args, kwargs, remaining, route))
+            return handler, args, kwargs
+        environ['routing.route'] = None
         return None, (), {}
 
-    def _gen_chunked(self, gen):
+    def _send_file(self, http, status, response):
+        try:
+            st = os.stat(response.path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            return 404, RESPONSES[404][1]
+
+        # revalidation and compression are handled (or skipped) right here
+        http.conditional = False
+        http.compression = None
+
+        size = st.st_size
+        etag = '"%x-%x"' % (int(st.st_mtime), size)
+        http.add_header('Content-Type', response.content_type)
+        http.add_header('Accept-Ranges', 'bytes')
+        http.add_header('ETag', etag)
+        http.add_header('Last-Modified',
+                email.utils.formatdate(st.st_mtime, usegmt=True))
+
+        if status != 200 or http.METHOD not in ('GET', 'HEAD'):
+            return status, ''
+        if _not_modified(http, etag, st.st_mtime):
+            return 304, ''
+
+        start, end = 0, size - 1
+        byte_range = http.headers.get('RANGE')
+        if byte_range is not None and _if_range(
+                http.headers.get('IF-RANGE'), etag, st.st_mtime):
+            byte_range = files.parse_range(byte_range, size)
+            if byte_range is False:
+                http.add_header('Content-Range', 'bytes */%d' % size)
+                return 416, ''
+            if byte_range is not None:
+                start, end = byte_range
+                status = 206
+                http.add_header('Content-Range',
+                        'bytes %d-%d/%d' % (start, end, size))
+
+        http.add_header('Content-Length', str(end - start + 1))
+        if http.METHOD == 'HEAD':
+            return status, ''
+
+        fp = open(response.path, 'rb')
+        file_wrapper = http.environ.get('wsgi.file_wrapper')
+        if status == 200 and file_wrapper is not None:
+            return status, file_wrapper(fp, response.block_size)
+        return status, files.mmap_iter(
+                fp, start, end - start + 1, response.block_size)
+
+    def _revalidate(self, http, status, message):
+        conditional = http.conditional
+        if conditional is NOT_SUPPLIED:
+            conditional = self.etags
+        if (not conditional or status != 200
+                or http.METHOD not in ('GET', 'HEAD')):
+            return status, message
+
+        etag = last_modified = None
+        for key, value in http._out_headers:
+            key = key.lower()
+            if key == 'etag':
+                etag = value
+            elif key == 'last-modified':
+                last_modified = email.utils.parsedate_tz(value)
+                if last_modified is not None:
+                    last_modified = email.utils.mktime_tz(last_modified)
+
+        if etag is None and isinstance(message, str):
+            etag = '"%s"' % hashlib.md5(message).hexdigest()
+            http.add_header('ETag', etag)
+
+        if not _not_modified(http, etag, last_modified):
+            return status, message
+
+        if hasattr(message, 'close'):
+            message.close()
+        http._out_headers = [(k, v) for k, v in http._out_headers
+                if k.lower() not in ('content-length', 'transfer-encoding')]
+        return 304, ''
+
+    def conditional(self, func=None, validator=None):
+        '''tag this route's responses and answer revalidations with a 304
+
+        without a `validator`, string responses are tagged with a hash of the
+        body (the handler can also add its own ETag or Last-Modified headers).
+        a `validator` is called with the handler's arguments before the
+        handler, and returns an etag, a unix timestamp of the last
+        modification, or an (etag, last_modified) pair (either may be None).
+        when that satisfies the request's If-None-Match or If-Modified-Since
+        the handler isn't run at all.
+
+        usable bare (@app.conditional) or with a validator
+        '''
+        if func is None:
+            return lambda func: self.conditional(func, validator)
+
+        def inner(http, *args, **kwargs):
+            http.conditional = True
+            if validator is not None:
+                result = validator(http, *args, **kwargs)
+                if isinstance(result, tuple):
+                    etag, last_modified = result
+                elif isinstance(result, basestring):
+                    etag, last_modified = result, None
+                else:
+                    etag, last_modified = None, result
+
+                if etag is not None:
+                    etag = _quote_etag(etag)
+                    http.add_header('ETag', etag)
+                if last_modified is not None:
+                    http.add_header('Last-Modified', email.utils.formatdate(
+                        last_modified, usegmt=True))
+                if (http.METHOD in ('GET', 'HEAD')
+                        and _not_modified(http, etag, last_modified)):
+                    raise Error(304, '')
+            return func(http, *args, **kwargs)
+
+        return inner
+
+    def metadata(self, meta):
+        '''answer HEAD requests for this route without running the handler
+
+        `meta` is called with the handler's arguments instead, adds the
+        headers the response would have (Content-Type, ETag, Last-Modified...)
+        and returns the length of the body, or None when that isn't known.
+        other methods still go to the handler. put this decorator directly
+        under the route's, so that nothing builds a body for HEAD.
+        '''
+        def decorate(func):
+            def inner(http, *args, **kwargs):
+                if http.METHOD != 'HEAD':
+                    return func(http, *args, **kwargs)
+                length = meta(http, *args, **kwargs)
+                if length is not None:
+                    http.add_header('Content-Length', str(length))
+                return _NO_BODY
+            return inner
+        return decorate
+
+    def cached(self, func=None, ttl=60, vary=(), cache=None):
+        '''cache this route's GET and HEAD responses
+
+        the status, headers and string body the handler produces are kept for
+        `ttl` seconds, keyed on the method, path, query parameters and the
+        values of the request headers named in `vary`. responses that set
+        cookies, bodies that aren't strings and errors are never cached.
+        `cache` is a caching.ResponseCache, by default the app's.
+
+        put this decorator directly on the handler, under any others, so that
+        they still run on cache hits.
+        '''
+        if func is None:
+            return lambda func: self.cached(func, ttl, vary, cache)
+
+        vary = tuple(name.upper().replace('_', '-') for name in vary)
+
+        def inner(http, *args, **kwargs):
+            if http.METHOD not in ('GET', 'HEAD'):
+                return func(http, *args, **kwargs)
+
+            store = cache if cache is not None else self.response_cache
+            environ = http.environ
+            # HEAD is answered from the GET response, and vice versa
+            key = ('GET',
+                    environ.get('SCRIPT_NAME', '') + environ['PATH_INFO'],
+                    tuple(sorted(http.GET.iterallitems())),
+                    tuple(http.headers.get(name) for name in vary))
+
+            def compute():
+                start = len(http._out_headers)
+                body = func(http, *args, **kwargs)
+                headers = http._out_headers[start:]
+                if (not isinstance(body, str)
+                        or http._out_code >= 500
+                        or any(k.lower() == 'set-cookie' for k, v in headers)
+                        or ('COOKIES' in http.__dict__
+                            and any(True for m in http.COOKIES.updated()))):
+                    return (None, body), 0, None
+                size = len(body) + sum(len(k) + len(v) for k, v in headers)
+                return (http._out_code, headers, body), size, ttl
+
+            (result, hit) = store.get_or_compute(key, compute)
+            if not hit and result[0] is None:
+                # uncacheable, and already applied to this request
+                return result[1]
+            code, headers, body = result
+            if hit:
+                http.set_code(code)
+                http._out_headers.extend(headers)
+            return body
+
+        return inner
+
+    def offload(self, func=None, workers=4, queue_size=16, timeout=None,
+            pool=None):
+        '''run this route's handler on a bounded pool of threads
+
+        for handlers that block on I/O or burn CPU. when `queue_size` calls
+        are already waiting for one of the `workers`, or the call isn't done
+        within `timeout` seconds, the request fails fast with a 503. pass an
+        offload.WorkerPool as `pool` to share one between routes; the pool is
+        available as the `pool` attribute of the decorated function, and its
+        stats() give the queue length, busy workers and wait times.
+
+        only the handler call itself is offloaded, a generator it returns is
+        still iterated by the server. with a `timeout`, a call still queued
+        when it runs out is never made, and one already running works on a
+        copy of the request so it can't change the 503 sent in the meantime.
+        timed waits poll on python 2 though, adding up to 50ms to each call
+        (see offload.WorkerPool.run), so leave it off on fast routes.
+        '''
+        if func is None:
+            return lambda func: self.offload(
+                    func, workers, queue_size, timeout, pool)
+
+        if pool is None:
+            pool = offload.WorkerPool(workers, queue_size)
+
+        def inner(http, *args, **kwargs):
+            if timeout is None:
+                try:
+                    return pool.run(func, (http,) + args, kwargs)
+                except offload.Saturated, exc:
+                    raise Error(503, str(exc))
+
+            detached = copy.copy(http)
+            detached._out_headers = list(http._out_headers)
+            try:
+                result = pool.run(func, (detached,) + args, kwargs, timeout)
+            except offload.Saturated, exc:
+                raise Error(503, str(exc))
+            except Exception:
+                http.__dict__.update(detached.__dict__)
+                raise
+            http.__dict__.update(detached.__dict__)
+            return result
+
+        inner.pool = pool
+        return inner
+
+    def _compress(self, http, status, message):
+        compression = http.compression
+        if compression is NOT_SUPPLIED:
+            compression = self.compression
+        if not compression or status < 200 or status in (204, 304):
+            return message
+
+        if isinstance(message, str):
+            if len(message) < compression.min_size:
+                return message
+        elif not hasattr(message, "__iter__"):
+            return message
+
+        content_type = None
+        for key, value in http._out_headers:
+            key = key.lower()
+            if key == 'content-encoding':
+                return message
+            if key == 'content-type':
+                content_type = value.lower()
+        if content_type and content_type.startswith(compression.skip_types):
+            return message
+
+        http.add_header('Vary', 'Accept-Encoding')
+        coding = compress.negotiate(http.headers.get('ACCEPT-ENCODING'))
+        if coding is None:
+            return message
+
+        # any length the handler set was for the uncompressed body
+        # the compressed body is only equivalent to the original, so any
+        # strong validator has to become a weak one
+        http._out_headers = [
+                (k, 'W/' + v if k.lower() == 'etag' and v.startswith('"')
+                    else v)
+                for k, v in http._out_headers
+                if k.lower() != 'content-length']
+        http.add_header('Content-Encoding', coding)
+
+        if isinstance(message, str):
+            return compression.compress_string(message, coding)
+        if isinstance(message, ChunkedBody):
+            message.source = compression.compress_iter(
+                    message.source, coding, FLUSH)
+            return message
+        return compression.compress_iter(message, coding)
+
+    def compressed(self, func=None, **options):
+        '''compress this route's responses when the client accepts it
+
+        takes the compress.Compression options (level, min_size, skip_types),
+        or enabled=False to turn off an app-wide setting for this route.
+        usable bare (@app.compressed) or with options
+        '''
+        if func is None:
+            return lambda func: self.compressed(func, **options)
+
+        if options.pop('enabled', True):
+            compression = compress.Compression(**options)
+        else:
+            compression = None
+
+        def inner(http, *args, **kwargs):
+            http.compression = compression
+            return func(http, *args, **kwargs)
+
+        return inner
+
+    def _gen_chunked(self, gen, min_size=0, max_latency=None):
+        pending, size, since = [], 0, None
         for chunk in gen:
+            if chunk is FLUSH:
+                if pending:
+                    chunk = ''.join(pending)
+                    pending, size = [], 0
+                    yield '%x\r\n%s\r\n' % (len(chunk), chunk)
+                continue
+
             # skip empty chunks
             if not chunk:
                 continue
+
+            if not min_size:
+                yield '%x\r\n%s\r\n' % (len(chunk), chunk)
+                continue
+
+            if not pending and max_latency is not None:
+                since = time.time()
+            pending.append(chunk)
+            size += len(chunk)
+
+            if size >= min_size or (max_latency is not None
+                    and time.time() - since >= max_latency):
+                chunk = ''.join(pending)
+                pending, size = [], 0
+                yield '%x\r\n%s\r\n' % (len(chunk), chunk)
+
+        if pending:
+            chunk = ''.join(pending)
             yield '%x\r\n%s\r\n' % (len(chunk), chunk)
         yield '0\r\n\r\n'
 
-    def chunked(self, func):
+    def chunked(self, func=None, min_size=0, max_latency=None):
+        '''send a generator handler's output with chunked transfer-encoding
+
+        with a `min_size`, yielded pieces are batched until at least that many
+        bytes are waiting, or until the oldest waiting piece is `max_latency`
+        seconds old (checked whenever the handler yields). handlers that block
+        between yields should yield FLUSH first so that what they have already
+        produced goes out right away.
+
+        usable bare (@app.chunked) or with options (@app.chunked(min_size=..))
+        '''
+        if func is None:
+            return lambda func: self.chunked(func, min_size, max_latency)
+
         def inner(http, *args, **kwargs):
             gen = func(http, *args, **kwargs)
             if not hasattr(gen, '__iter__'):
                 return gen
 
             http.add_header('Transfer-Encoding', 'chunked')
-            return self._gen_chunked(gen)
+            return ChunkedBody(gen, self._gen_chunked, min_size, max_latency)
+
+        return inner
+
+    def sse(self, func=None, retry=None):
+        '''stream a handler's output as server-sent events
+
+        the handler returns or yields sse.Event objects (strings are sent as
+        the data of plain events), typically a Broadcaster subscription. it
+        goes out chunked, each event as soon as it is produced, uncompressed
+        and with caching disabled. the stream opens with `retry`, the client's
+        reconnection delay in milliseconds, or else with a keepalive comment,
+        so the response starts before there are any events.
+
+        handlers that produce their own events and wait between them should
+        yield sse.HEARTBEAT every so often, so idle connections stay open and
+        ones whose client has left get noticed. to refuse a request (raising
+        Error), do it before returning the events: a generator handler's body
+        only runs once the response has started.
+        '''
+        if func is None:
+            return lambda func: self.sse(func, retry)
+
+        def events(http, source):
+            # something has to come out straight away, or the response (and
+            # its headers) would wait for the first event
+            if retry is not None:
+                yield sse.Event(retry=retry).encoded
+            else:
+                yield sse.HEARTBEAT.encoded
+            for event in source:
+                if not isinstance(event, sse.Event):
+                    event = sse.Event(event)
+                yield event.encoded
+
+        stream = self.chunked(events)
+
+        def inner(http, *args, **kwargs):
+            # called now rather than once the body is being sent, so that the
+            # handler can still fail the request with an Error
+            source = func(http, *args, **kwargs)
+            http.add_header('Content-Type', 'text/event-stream')
+            http.add_header('Cache-Control', 'no-cache')
+            # ask proxies like nginx not to buffer the stream
+            http.add_header('X-Accel-Buffering', 'no')
+            http.compression = None
+            http.conditional = False
+            return stream(http, source)
+
+        return inner
+
+    def json(self, func=None, ndjson=False, batch_size=100, **options):
+        '''send a handler's return value as JSON
+
+        iterators and generators of records (and lists and tuples) are
+        streamed chunked as a JSON array, encoded `batch_size` records at a
+        time (see jsonstream.iterencode), so memory use doesn't grow with the
+        number of records. with `ndjson` they go out as newline-delimited
+        JSON instead. anything else is encoded in one go, and strings are
+        taken to be JSON already. other keyword arguments are passed on to
+        json.JSONEncoder.
+
+        usable bare (@app.json) or with options (@app.json(ndjson=True))
+        '''
+        if func is None:
+            return lambda func: self.json(func, ndjson, batch_size, **options)
+
+        options.setdefault('separators', (',', ':'))
+        encoder = jsonstream.json.JSONEncoder(**options)
+        content_type = 'application/x-ndjson' if ndjson \
+                else 'application/json'
+
+        def inner(http, *args, **kwargs):
+            result = func(http, *args, **kwargs)
+            http.add_header('Content-Type', content_type)
+            if isinstance(result, basestring):
+                return result
+            if not hasattr(result, 'next') \
+                    and not isinstance(result, (list, tuple)):
+                result = encoder.encode(result)
+                if isinstance(result, unicode):
+                    result = result.encode('utf8')
+                return result
+
+            http.add_header('Transfer-Encoding', 'chunked')
+            return ChunkedBody(jsonstream.iterencode(result, ndjson,
+                batch_size, encoder), self._gen_chunked)
 
         return inner
 
@@ -251,22 +1167,186 @@ class Error(Exception):
 def _hash_morsel(morsel):
     return hash((morsel.coded_value,) + tuple(sorted(dict(morsel).items())))
 
+
+class _TrackedMorsel(Cookie.Morsel):
+    # tells its cookie about any change, just before it's made
+
+    def __init__(self, owner=None):
+        self._owner = None
+        Cookie.Morsel.__init__(self)
+        self._owner = owner
+
+    def _touch(self, key=None):
+        owner = self.__dict__.get('_owner')
+        if owner is None:
+            return
+        key = self.key if key is None else key
+        if key is not None:
+            owner._touch(key)
+
+    def __setattr__(self, name, value):
+        if name in ('key', 'value', 'coded_value'):
+            self._touch()
+        object.__setattr__(self, name, value)
+
+    def __setitem__(self, K, V):
+        self._touch()
+        Cookie.Morsel.__setitem__(self, K, V)
+
+    def set(self, key, val, coded_val, *args, **kwargs):
+        self._touch(key)
+        Cookie.Morsel.set(self, key, val, coded_val, *args, **kwargs)
+
+    def __delitem__(self, K):
+        self._touch()
+        dict.__delitem__(self, K)
+
+    def update(self, *args, **kwargs):
+        self._touch()
+        dict.update(self, *args, **kwargs)
+
+    def setdefault(self, K, V=None):
+        self._touch()
+        return dict.setdefault(self, K, V)
+
+    def pop(self, K, *default):
+        self._touch()
+        return dict.pop(self, K, *default)
+
+    def clear(self):
+        self._touch()
+        dict.clear(self)
+
+
 class ChangeDetectingCookie(Cookie.SimpleCookie):
-    def __init__(self, *args, **kwargs):
-        super(ChangeDetectingCookie, self).__init__(*args, **kwargs)
-        self._stamps = dict((k, _hash_morsel(m)) for k, m in self.items())
+    '''a SimpleCookie that knows which of its morsels have been changed
+
+    the cookie string is only parsed on first use, and writes (through the
+    cookie or its morsels) mark keys as dirty, so that `updated` only has to
+    look at those. a request that never changes a cookie costs nothing.
+    '''
+    def __init__(self, input=None):
+        self._raw = input or None
+        self._parsing = False
+        self._parsed_keys = frozenset()
+        self._dirty = set()
+        self._stamps = {}
+
+    def _parse(self):
+        raw, self._raw = self._raw, None
+        # parse into plain morsels, which is quicker, and only then turn them
+        # into tracked ones
+        self._parsing = True
+        try:
+            Cookie.SimpleCookie.load(self, raw)
+        finally:
+            self._parsing = False
+        for morsel in dict.itervalues(self):
+            morsel.__class__ = _TrackedMorsel
+            morsel.__dict__['_owner'] = self
+        self._parsed_keys = frozenset(dict.iterkeys(self))
+
+    def _touch(self, key):
+        # called just before `key` changes, so its original state is stamped
+        if self._parsing or key in self._dirty:
+            return
+        self._dirty.add(key)
+        if key in self._parsed_keys and dict.__contains__(self, key):
+            self._stamps[key] = _hash_morsel(dict.__getitem__(self, key))
+
+    def _BaseCookie__set(self, key, real_value, coded_value):
+        if self._parsing:
+            return Cookie.SimpleCookie._BaseCookie__set(
+                    self, key, real_value, coded_value)
+        morsel = dict.get(self, key)
+        if morsel is None:
+            morsel = _TrackedMorsel(self)
+        else:
+            self._touch(key)
+        morsel.set(key, real_value, coded_value)
+        dict.__setitem__(self, key, morsel)
+
+    def __setitem__(self, key, value):
+        if self._raw is not None:
+            self._parse()
+        self._touch(key)
+        Cookie.SimpleCookie.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self._raw is not None:
+            self._parse()
+        self._touch(key)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if self._raw is not None:
+            self._parse()
+        self._touch(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        if self._raw is not None:
+            self._parse()
+        for key in dict.iterkeys(self):
+            break
+        else:
+            raise KeyError('popitem(): dictionary is empty')
+        self._touch(key)
+        return key, dict.pop(self, key)
+
+    def update(self, *args, **kwargs):
+        # dict.update would bypass the tracking in __setitem__
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if self._raw is not None:
+            self._parse()
+        if not dict.__contains__(self, key):
+            self._touch(key)
+        return dict.setdefault(self, key, default)
+
+    def clear(self):
+        if self._raw is not None:
+            self._parse()
+        for key in dict.keys(self):
+            self._touch(key)
+        dict.clear(self)
 
     def updated(self, deleted=True):
+        if self._raw is not None:
+            # never even parsed, so nothing can have changed
+            return
+
         # yield all the morsels added or updated
-        for key, morsel in self.iteritems():
-            if _hash_morsel(morsel) != self._stamps.get(key):
+        dirty = self._dirty
+        for key, morsel in dict.iteritems(self):
+            if key in dirty and _hash_morsel(morsel) != self._stamps.get(key):
                 yield morsel
 
         if deleted:
             # yield timed-out morsels for all those deleted
-            for key, stamp in self._stamps.iteritems():
-                if key not in self:
+            for key in self._parsed_keys:
+                if not dict.__contains__(self, key):
                     morsel = Cookie.Morsel()
                     morsel.set(key, "", "")
                     morsel['expires'] = morsel['max-age'] = 0
                     yield morsel
+
+
+def _parsed_first(name):
+    method = getattr(Cookie.SimpleCookie, name)
+    def wrapper(self, *args, **kwargs):
+        if self._raw is not None:
+            self._parse()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+# everything else that reads (or loads into) the cookie parses it first
+for _name in ('__getitem__', '__contains__', '__iter__', '__len__',
+        '__repr__', '__eq__', '__ne__', 'get', 'has_key', 'keys', 'values',
+        'items', 'iterkeys', 'itervalues', 'iteritems', 'copy', 'output',
+        'js_output', 'load'):
+    setattr(ChangeDetectingCookie, _name, _parsed_first(_name))
+del _name
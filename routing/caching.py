@@ -0,0 +1,113 @@
+from __future__ import absolute_import
+
+import collections
+import threading
+import time
+
+
+__all__ = ["ResponseCache"]
+
+
+class ResponseCache(object):
+    '''a store of rendered responses, bounded by their total size in bytes
+
+    entries expire after their TTL, and the least recently used ones are
+    evicted once `max_bytes` is exceeded. concurrent misses on the same key
+    are coalesced, see `get_or_compute`.
+    '''
+    def __init__(self, max_bytes=2**26, wait_timeout=30):
+        self.max_bytes = max_bytes
+        self.wait_timeout = wait_timeout
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        # must hold the lock
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self.size -= entry[1]
+            return None
+        self._entries[key] = entry
+        return entry[2]
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def put(self, key, value, size, ttl):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (time.time() + ttl, size, value)
+            self.size += size
+            while self.size > self.max_bytes:
+                expires, old_size, old_value = self._entries.popitem(
+                        last=False)[1]
+                self.size -= old_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def get_or_compute(self, key, compute):
+        '''look up `key`, or call `compute()` to produce it
+
+        `compute` returns a (value, size, ttl) triple, where a None ttl means
+        the value mustn't be cached. while one caller is computing a key,
+        others asking for it wait for that result rather than computing it
+        again themselves (up to `wait_timeout` seconds).
+
+        returns (value, hit)
+        '''
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                self.hits += 1
+                return value, True
+            self.misses += 1
+            event = self._pending.get(key)
+            leader = event is None
+            if leader:
+                event = self._pending[key] = threading.Event()
+
+        if not leader:
+            event.wait(self.wait_timeout)
+            with self._lock:
+                value = self._get(key)
+                if value is not None:
+                    self.hits += 1
+                    return value, True
+
+        try:
+            value, size, ttl = compute()
+            if ttl is not None:
+                self.put(key, value, size, ttl)
+            return value, False
+        finally:
+            if leader:
+                with self._lock:
+                    del self._pending[key]
+                event.set()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+        }
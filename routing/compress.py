@@ -0,0 +1,90 @@
+from __future__ import absolute_import
+
+import zlib
+
+
+__all__ = ["Compression", "negotiate"]
+
+# zlib window bits that produce each content-coding's framing
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+SKIP_TYPES = (
+    'image/', 'video/', 'audio/',
+    'application/zip', 'application/gzip', 'application/x-gzip',
+    'application/x-bzip2', 'application/x-7z-compressed',
+    'application/octet-stream', 'font/woff',
+)
+
+
+def negotiate(accept_encoding, supported=('gzip', 'deflate')):
+    '''pick the content-coding to use given an Accept-Encoding header
+
+    returns one of `supported` (earlier entries win ties), or None
+    '''
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params[:2].lower() == 'q=':
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qualities[coding] = q
+
+    best, best_q = None, 0.0
+    for coding in supported:
+        q = qualities.get(coding, qualities.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class Compression(object):
+    '''response compression settings
+
+    :param level: zlib compression level, 1-9
+    :param min_size: string bodies shorter than this go out uncompressed
+    :param skip_types: Content-Type prefixes that are never compressed
+        (already-compressed media, mostly)
+    '''
+    def __init__(self, level=6, min_size=512, skip_types=SKIP_TYPES):
+        self.level = level
+        self.min_size = min_size
+        self.skip_types = tuple(skip_types)
+
+    def compressor(self, coding):
+        return zlib.compressobj(self.level, zlib.DEFLATED, WBITS[coding])
+
+    def compress_string(self, data, coding):
+        compressor = self.compressor(coding)
+        return compressor.compress(data) + compressor.flush()
+
+    def compress_iter(self, iterable, coding, flush_marker=None):
+        '''incrementally compress an iterable of strings
+
+        if `flush_marker` turns up in the iterable, everything compressed so
+        far is flushed out and the marker is passed along after it
+        '''
+        compressor = self.compressor(coding)
+        for chunk in iterable:
+            if flush_marker is not None and chunk is flush_marker:
+                data = compressor.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+                yield chunk
+                continue
+            if not chunk:
+                continue
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
@@ -0,0 +1,378 @@
+from __future__ import absolute_import
+
+import collections
+import heapq
+import itertools
+import re
+import sre_constants
+import sre_parse
+import threading
+
+
+__all__ = ["Router", "LRUCache", "literal_prefix", "sample_paths"]
+
+
+def literal_prefix(regex):
+    '''The literal text every match of the compiled `regex` must start with
+
+    `regex.match()` always anchors at the start of the string, so a path that
+    doesn't begin with this prefix can't possibly match the pattern.
+    '''
+    if regex.flags & re.IGNORECASE:
+        return ''
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except (sre_constants.error, TypeError):
+        return ''
+
+    to_char = unichr if isinstance(regex.pattern, unicode) else chr
+    chars = []
+    _collect_literals(parsed, chars, to_char)
+    return ''.join(chars)
+
+def _collect_literals(parsed, chars, to_char):
+    # returns True if every item in `parsed` was a literal
+    for op, av in parsed:
+        if op is sre_constants.AT and av in (
+                sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING):
+            continue
+        if op is sre_constants.LITERAL:
+            if av > 255 and to_char is chr:
+                return False
+            chars.append(to_char(av))
+            continue
+        if op is sre_constants.SUBPATTERN and av[-1] is not None:
+            if _collect_literals(av[-1], chars, to_char):
+                continue
+        return False
+    return True
+
+
+# characters tried for the wildcards and classes in a pattern
+_SAMPLE_CHARS = 'a/0_-.A~ '
+
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: lambda c: c.isdigit(),
+    sre_constants.CATEGORY_NOT_DIGIT: lambda c: not c.isdigit(),
+    sre_constants.CATEGORY_SPACE: lambda c: c.isspace(),
+    sre_constants.CATEGORY_NOT_SPACE: lambda c: not c.isspace(),
+    sre_constants.CATEGORY_WORD: lambda c: c.isalnum() or c == '_',
+    sre_constants.CATEGORY_NOT_WORD: lambda c: not (c.isalnum() or c == '_'),
+    sre_constants.CATEGORY_LINEBREAK: lambda c: c == '\n',
+    sre_constants.CATEGORY_NOT_LINEBREAK: lambda c: c != '\n',
+}
+
+class _Unsupported(Exception):
+    pass
+
+def sample_paths(regex, limit=32):
+    '''A few strings that the compiled `regex` matches
+
+    made by walking the pattern and trying a handful of characters for every
+    wildcard, class and repeat in it, so they're representative rather than
+    exhaustive. returns an empty list for patterns it can't follow.
+    '''
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+        to_char = unichr if isinstance(regex.pattern, unicode) else chr
+        samples = _samples(parsed, to_char, limit)
+    except (_Unsupported, sre_constants.error, TypeError, ValueError):
+        return []
+
+    items = list(parsed)
+    if not (items and items[-1][0] is sre_constants.AT and items[-1][1] in (
+            sre_constants.AT_END, sre_constants.AT_END_STRING)):
+        # the pattern only has to match the start of the path, so try
+        # longer paths too
+        samples = samples + [sample + suffix
+                for suffix in ('/', '/a') for sample in samples]
+
+    seen, found = set(), []
+    for sample in samples:
+        if sample not in seen and regex.match(sample):
+            seen.add(sample)
+            found.append(sample)
+    return found
+
+def _samples(parsed, to_char, limit):
+    empty = to_char(0)[:0]
+    combined = [empty]
+    for op, av in parsed:
+        options = _item_samples(op, av, to_char, limit)
+        combined = [a + b for a, b in
+                itertools.islice(itertools.product(combined, options), limit)]
+    return combined
+
+def _item_samples(op, av, to_char, limit):
+    empty = to_char(0)[:0]
+    if op is sre_constants.LITERAL:
+        return [to_char(av)]
+    if op is sre_constants.NOT_LITERAL:
+        return [c for c in _SAMPLE_CHARS if ord(c) != av][:2]
+    if op is sre_constants.ANY:
+        return ['a', '/']
+    if op is sre_constants.IN:
+        return _class_samples(av, to_char)
+    if op is sre_constants.SUBPATTERN:
+        return _samples(av[-1], to_char, limit)
+    if op is sre_constants.BRANCH:
+        found = []
+        for branch in av[1]:
+            found.extend(_samples(branch, to_char, limit))
+        return found[:limit]
+    if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+        low, high, sub = av
+        options = _samples(sub, to_char, limit)[:3]
+        counts = [n for n in (low, low + 1, low + 2) if n <= high]
+        found = []
+        for n in counts:
+            for option in options:
+                if option * n not in found:
+                    found.append(option * n)
+        return found[:limit]
+    if op in (sre_constants.AT, sre_constants.ASSERT,
+            sre_constants.ASSERT_NOT, sre_constants.GROUPREF):
+        # anchors and lookarounds don't consume anything, and the samples
+        # that break them are filtered out afterwards
+        return [empty]
+    raise _Unsupported(op)
+
+def _class_samples(items, to_char):
+    negate = False
+    candidates = []
+    for op, av in items:
+        if op is sre_constants.NEGATE:
+            negate = True
+        elif op is sre_constants.LITERAL:
+            candidates.append(to_char(av))
+        elif op is sre_constants.RANGE:
+            candidates.append(to_char(av[0]))
+    candidates.extend(_SAMPLE_CHARS)
+
+    def accepts(char):
+        code = ord(char)
+        for op, av in items:
+            if op is sre_constants.LITERAL and code == av:
+                return not negate
+            if op is sre_constants.RANGE and av[0] <= code <= av[1]:
+                return not negate
+            if op is sre_constants.CATEGORY and av in _CATEGORIES \
+                    and _CATEGORIES[av](char):
+                return not negate
+        return negate
+
+    found = []
+    for char in candidates:
+        if char not in found and accepts(char):
+            found.append(char)
+            if len(found) == 3:
+                break
+    return found
+
+
+class _Node(object):
+    __slots__ = ['children', 'routes', 'merged']
+
+    def __init__(self):
+        # first character of the edge label -> (edge label, child node)
+        self.children = {}
+        self.routes = []
+        # once frozen: this node's routes and all its ancestors', in order
+        self.merged = None
+
+
+class Router(object):
+    '''Ordered route table for a single request method
+
+    Patterns are indexed in a radix tree by their literal prefix, so a lookup
+    only runs the regexes whose prefix matches the path (plus those that have
+    no literal prefix at all), still in registration order.
+    '''
+    def __init__(self):
+        self.routes = []
+        self.frozen = False
+        self._root = _Node()
+
+    def __len__(self):
+        return len(self.routes)
+
+    def add(self, regex, handler):
+        if self.frozen:
+            raise RuntimeError("can't add routes to a frozen router")
+        index = len(self.routes)
+        self.routes.append((regex, handler))
+
+        prefix = literal_prefix(regex)
+        node = self._root
+        while prefix:
+            edge = node.children.get(prefix[0])
+            if edge is None:
+                child = _Node()
+                node.children[prefix[0]] = (prefix, child)
+                node = child
+                break
+
+            label, child = edge
+            common = 1
+            limit = min(len(label), len(prefix))
+            while common < limit and label[common] == prefix[common]:
+                common += 1
+
+            if common < len(label):
+                # split the edge at the point the two prefixes diverge
+                middle = _Node()
+                middle.children[label[common]] = (label[common:], child)
+                node.children[prefix[0]] = (label[:common], middle)
+                child = middle
+
+            prefix = prefix[common:]
+            node = child
+
+        node.routes.append(index)
+
+    def freeze(self):
+        '''Stop accepting routes, and precompute every node's candidates
+
+        lookups then find the deepest node matching the path and return its
+        list as is, rather than merging the lists along the way.
+        '''
+        stack = [(self._root, ())]
+        while stack:
+            node, inherited = stack.pop()
+            if node.routes:
+                node.merged = tuple(sorted(inherited + tuple(node.routes)))
+            else:
+                node.merged = inherited
+            for label, child in node.children.itervalues():
+                stack.append((child, node.merged))
+        self.frozen = True
+
+    def candidates(self, path):
+        '''Indexes of the routes that could match `path`, in order'''
+        node = self._root
+        if self.frozen:
+            pos, length = 0, len(path)
+            while pos < length:
+                edge = node.children.get(path[pos])
+                if edge is None:
+                    break
+                label, child = edge
+                if not path.startswith(label, pos):
+                    break
+                pos += len(label)
+                node = child
+            return node.merged
+
+        found = [node.routes] if node.routes else []
+        pos, length = 0, len(path)
+        while pos < length:
+            edge = node.children.get(path[pos])
+            if edge is None:
+                break
+            label, node = edge
+            if not path.startswith(label, pos):
+                break
+            pos += len(label)
+            if node.routes:
+                found.append(node.routes)
+
+        if not found:
+            return ()
+        if len(found) == 1:
+            return found[0]
+        return heapq.merge(*found)
+
+    def match(self, path):
+        '''Find the first route matching `path`
+
+        returns a (regex, handler, match) triple, or None
+        '''
+        routes = self.routes
+        for index in self.candidates(path):
+            regex, handler = routes[index]
+            match = regex.match(path)
+            if match:
+                return regex, handler, match
+        return None
+
+    def first_index(self, path):
+        '''Index of the first route matching `path`, or None'''
+        routes = self.routes
+        for index in self.candidates(path):
+            if routes[index][0].match(path):
+                return index
+        return None
+
+    def overlaps(self, taken=None):
+        '''Find routes that earlier ones (partly) hide
+
+        tries sample paths for every route (see `sample_paths`) and checks
+        which route actually gets each of them. `taken` may be a function
+        that returns a description of whatever else claims a path before this
+        router is consulted, or None.
+
+        yields (index, earlier, unreachable) triples, where `earlier` lists
+        the indexes (or `taken` descriptions) of whatever got the paths and
+        `unreachable` is true when none of them went to the route itself
+        '''
+        for index, (regex, handler) in enumerate(self.routes):
+            reached, earlier = False, []
+            for path in sample_paths(regex):
+                winner = taken(path) if taken is not None else None
+                if winner is None:
+                    winner = self.first_index(path)
+                if winner == index:
+                    reached = True
+                elif winner not in earlier:
+                    earlier.append(winner)
+            if earlier:
+                yield index, earlier, not reached
+
+
+class LRUCache(object):
+    '''A bounded mapping that evicts the least recently used entry
+
+    keeps hit/miss/eviction counters so the size can be tuned. safe to share
+    between threads.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            data = self._data
+            data.pop(key, None)
+            data[key] = value
+            while len(data) > self.maxsize:
+                data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+
+import mimetypes
+import mmap
+
+
+__all__ = ["FileResponse"]
+
+
+class FileResponse(object):
+    '''return one of these from a handler to send a file from disk
+
+    App takes care of Content-Type, Content-Length, Last-Modified and ETag,
+    revalidation (304), single byte ranges (206) and HEAD. the body goes out
+    through the server's wsgi.file_wrapper when there is one (so it can use
+    sendfile), otherwise from an mmap of the file.
+
+    :param path: the file to send, a missing one is a 404
+    :param content_type: guessed from the path by default
+    :param block_size: size of the pieces the body is sent in
+    '''
+    def __init__(self, path, content_type=None, block_size=2**16):
+        self.path = path
+        if content_type is None:
+            content_type = mimetypes.guess_type(path)[0] \
+                    or 'application/octet-stream'
+        self.content_type = content_type
+        self.block_size = block_size
+
+
+def parse_range(header, size):
+    '''parse a Range header against a file of `size` bytes
+
+    returns an inclusive (start, end) pair, None when the header should be
+    ignored (malformed, not bytes, or more than one range), or False when the
+    range can't be satisfied
+    '''
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    first, dash, last = spec.strip().partition('-')
+    if not dash:
+        return None
+    try:
+        if not first:
+            # suffix range: the last N bytes
+            length = int(last)
+            if length <= 0 or not size:
+                return False
+            return max(0, size - length), size - 1
+
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+
+    if start < 0:
+        return None
+    if start >= size:
+        return False
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def mmap_iter(fp, start, length, block_size):
+    '''send `length` bytes of `fp` from `start`, in block_size pieces'''
+    try:
+        if length <= 0:
+            return
+        try:
+            view = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # not mappable, fall back to reading it
+            fp.seek(start)
+            while length > 0:
+                data = fp.read(min(block_size, length))
+                if not data:
+                    break
+                length -= len(data)
+                yield data
+            return
+
+        try:
+            end = start + length
+            for offset in xrange(start, end, block_size):
+                yield view[offset:min(offset + block_size, end)]
+        finally:
+            view.close()
+    finally:
+        fp.close()
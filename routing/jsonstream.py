@@ -0,0 +1,52 @@
+from __future__ import absolute_import
+
+import itertools
+import json
+
+
+__all__ = ["iterencode"]
+
+
+def iterencode(records, ndjson=False, batch_size=100, encoder=None):
+    '''encode an iterable of records as JSON, a batch of them at a time
+
+    produces a JSON array, or with `ndjson` one document per line. each
+    string yielded holds `batch_size` records, so no more than that many are
+    ever encoded and held at once, however many there are in all.
+
+    :param encoder: a json.JSONEncoder, a compact one by default
+    '''
+    if encoder is None:
+        encoder = json.JSONEncoder(separators=(',', ':'))
+    encode = encoder.encode
+    records = iter(records)
+
+    if ndjson:
+        opening, separator, closing = '', '\n', '\n'
+    else:
+        opening, separator, closing = '[', ',', ']'
+
+    first = True
+    while 1:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        if ndjson:
+            batch = separator.join(itertools.imap(encode, batch))
+        else:
+            # one call for the batch is much quicker than one per record
+            batch = encode(batch)[1:-1]
+        if isinstance(batch, unicode):
+            batch = batch.encode('utf8')
+        if first:
+            yield opening + batch
+            first = False
+        else:
+            yield separator + batch
+
+    if first:
+        # no records at all
+        if not ndjson:
+            yield opening + closing
+    else:
+        yield closing
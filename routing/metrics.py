@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+
+import bisect
+import time
+
+
+__all__ = ["RouteStats"]
+
+# upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0)
+
+PHASES = ('resolve', 'handler', 'body', 'total')
+
+
+class _Histogram(object):
+    __slots__ = ['counts', 'sum']
+
+    def __init__(self, size):
+        # one extra bucket for everything beyond the last bound
+        self.counts = [0] * (size + 1)
+        self.sum = 0.0
+
+
+class _Record(object):
+    __slots__ = ['count', 'errors', 'statuses', 'latency']
+
+    def __init__(self, size):
+        self.count = 0
+        self.errors = 0
+        self.statuses = {}
+        self.latency = dict((phase, _Histogram(size)) for phase in PHASES)
+
+
+class RouteStats(object):
+    '''request counts and latency histograms per route
+
+    routes are identified by (method, pattern), the pattern being the regex
+    that matched rather than the path, so that /user/1/ and /user/2/ count
+    as the same route. requests that matched nothing count under None.
+
+    each request is timed in three phases: resolving the route, running the
+    handler and preparing the response, and iterating the body (until the
+    last chunk of a generator or chunked response is sent).
+    '''
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._records = {}
+
+    def record(self, route, status, resolve, handler, body, error=False):
+        record = self._records.get(route)
+        if record is None:
+            record = self._records[route] = _Record(len(self.buckets))
+
+        record.count += 1
+        if error or status >= 500:
+            record.errors += 1
+        status_class = '%dxx' % (status // 100)
+        record.statuses[status_class] = \
+                record.statuses.get(status_class, 0) + 1
+
+        buckets, latency = self.buckets, record.latency
+        for phase, seconds in (('resolve', resolve), ('handler', handler),
+                ('body', body), ('total', resolve + handler + body)):
+            histogram = latency[phase]
+            histogram.counts[bisect.bisect_left(buckets, seconds)] += 1
+            histogram.sum += seconds
+
+    def timed_body(self, body, route, status, resolve, handler, error=False):
+        '''wrap a response body so the request is recorded once it's sent'''
+        return _TimedBody(self, body, route, status, resolve, handler, error)
+
+    def snapshot(self, reset=False):
+        '''a plain-data copy of everything recorded so far
+
+        {(method, pattern): {'count': n, 'errors': n, 'statuses': {'2xx': n},
+            'latency': {phase: {'buckets': [(upper bound, n), ...],
+                                'sum': seconds}}}}
+
+        the last bucket's upper bound is None (unbounded)
+        '''
+        records = self._records
+        if reset:
+            self._records = {}
+
+        bounds = self.buckets + (None,)
+        result = {}
+        for route, record in records.items():
+            result[route] = {
+                'count': record.count,
+                'errors': record.errors,
+                'statuses': dict(record.statuses),
+                'latency': dict((phase, {
+                    'buckets': zip(bounds, histogram.counts),
+                    'sum': histogram.sum,
+                }) for phase, histogram in record.latency.iteritems()),
+            }
+        return result
+
+    def reset(self):
+        self._records = {}
+
+
+class _TimedBody(object):
+    def __init__(self, stats, body, route, status, resolve, handler, error):
+        self.stats = stats
+        self.body = body
+        self.info = (route, status, resolve, handler, error)
+        self.started = time.time()
+        self.done = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.body:
+                yield chunk
+        finally:
+            self.finish()
+
+    def finish(self):
+        if not self.done:
+            self.done = True
+            route, status, resolve, handler, error = self.info
+            self.stats.record(route, status, resolve, handler,
+                    time.time() - self.started, error)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.finish()
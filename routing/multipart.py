@@ -39,11 +39,11 @@ __license__ = 'MIT'
 
 from tempfile import TemporaryFile
 from wsgiref.headers import Headers
-import re, sys
+import mmap, os, re, sys
 try:
-    from urlparse import parse_qs
-except ImportError: # pragma: no cover (fallback for Python 2.5)
-    from cgi import parse_qs
+    from urllib import unquote
+except ImportError: # pragma: no cover (Python 3)
+    from urllib.parse import unquote
 try:
     from io import BytesIO
 except ImportError: # pragma: no cover (fallback for Python 2.5)
@@ -59,22 +59,56 @@ try:
 except ImportError: # pragma: no cover (fallback for Python 2.5)
     from UserDict import DictMixin
 
-class MultiDict(DictMixin):
+class MultiDict(object):
     """ A dict that remembers old values for each key """
+    __slots__ = ['dict']
+
     def __init__(self, *a, **k):
-        self.dict = dict()
-        for k, v in dict(*a, **k).iteritems():
-            self[k] = v
+        # build straight from pairs (or a mapping), keeping repeated keys
+        self.dict = d = {}
+        if a:
+            items = a[0]
+            if hasattr(items, 'iterallitems'): items = items.iterallitems()
+            elif hasattr(items, 'iteritems'): items = items.iteritems()
+            for key, value in items:
+                if key in d: d[key].append(value)
+                else: d[key] = [value]
+        for key, value in k.iteritems():
+            if key in d: d[key].append(value)
+            else: d[key] = [value]
 
     def __len__(self): return len(self.dict)
     def __iter__(self): return iter(self.dict)
     def __contains__(self, key): return key in self.dict
     def __delitem__(self, key): del self.dict[key]
-    def keys(self): return self.dict.keys()
-    def __getitem__(self, key): return self.get(key, KeyError, -1)
+    def __getitem__(self, key): return self.dict[key][-1]
     def __setitem__(self, key, value): self.append(key, value)
+    def __repr__(self): return '%s(%r)' % (type(self).__name__, self.allitems())
+
+    # what the MutableMapping mixin used to provide
+    __hash__ = None
+    def __eq__(self, other):
+        if isinstance(other, MultiDict): return self.dict == other.dict
+        if isinstance(other, DictMixin):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
 
-    def append(self, key, value): self.dict.setdefault(key, []).append(value)
+    def keys(self): return self.dict.keys()
+    def iterkeys(self): return self.dict.iterkeys()
+    def values(self): return [v[-1] for v in self.dict.itervalues()]
+    def itervalues(self): return (v[-1] for v in self.dict.itervalues())
+    def items(self): return [(k, v[-1]) for k, v in self.dict.iteritems()]
+    def iteritems(self): return ((k, v[-1]) for k, v in self.dict.iteritems())
+    def has_key(self, key): return key in self.dict
+    def clear(self): self.dict.clear()
+
+    def append(self, key, value):
+        d = self.dict
+        if key in d: d[key].append(value)
+        else: d[key] = [value]
     def replace(self, key, value): self.dict[key] = [value]
     def getall(self, key): return self.dict.get(key) or []
 
@@ -83,11 +117,29 @@ class MultiDict(DictMixin):
             return [default][index]
         return self.dict[key][index]
 
+    def pop(self, key, *default):
+        if key not in self.dict and default:
+            return default[0]
+        return self.dict.pop(key)[-1]
+
+    def setdefault(self, key, default=None):
+        if key not in self.dict:
+            self.dict[key] = [default]
+        return self.dict[key][-1]
+
+    def update(self, *a, **k):
+        for key, value in MultiDict(*a, **k).iterallitems():
+            self.append(key, value)
+
     def iterallitems(self):
         for key, values in self.dict.iteritems():
             for value in values:
                 yield key, value
 
+    def allitems(self): return list(self.iterallitems())
+
+if hasattr(DictMixin, 'register'): DictMixin.register(MultiDict)
+
 def tob(data, enc='utf8'): # Convert strings to bytes (py2 and py3)
     return data.encode(enc) if isinstance(data, unicode) else data
 
@@ -148,13 +200,21 @@ class MultipartParser(object):
     
     def __init__(self, stream, boundary, content_length=-1,
                  disk_limit=2**30, mem_limit=2**20, memfile_limit=2**18,
-                 buffer_size=2**16, charset='latin1'):
+                 buffer_size=2**16, charset='latin1', sink=None,
+                 spool_dir=None):
         ''' Parse a multipart/form-data byte stream. This object is an iterator
             over the parts of the message.
             
             :param stream: A file-like stream. Must implement ``.read(size)``.
             :param boundary: The multipart boundary as a byte string.
             :param content_length: The maximum number of bytes to read.
+            :param sink: Called with each part once its headers are parsed.
+                         It may return a path, a writable file object or a
+                         callable, and the body is written straight there
+                         instead of being buffered. None buffers as usual.
+            :param spool_dir: Where parts larger than memfile_limit are
+                              spooled to (the system default if None). See
+                              :meth:`MultipartPart.mmap`.
         '''
         self.stream, self.boundary = stream, boundary
         self.content_length = content_length
@@ -163,6 +223,8 @@ class MultipartParser(object):
         self.mem_limit = min(mem_limit, self.disk_limit)
         self.buffer_size = min(buffer_size, self.mem_limit)
         self.charset = charset
+        self.sink = sink
+        self.spool_dir = spool_dir
         if self.buffer_size - 6 < len(boundary): # "--boundary--\r\n"
             raise MultipartError('Boundary does not fit into buffer_size.')
         self._done = []
@@ -193,6 +255,161 @@ class MultipartParser(object):
         ''' Return a list of parts with that name. '''
         return [p for p in self if p.name == name]
 
+    def close(self):
+        ''' Close every part parsed so far, see :meth:`MultipartPart.close`. '''
+        for part in self._done:
+            part.close()
+
+    def _chunkiter(self):
+        ''' Iterate over the raw stream in chunks of at most buffer_size bytes,
+            stopping after content_length bytes.
+        '''
+        read = self.stream.read
+        maxread, maxbuf = self.content_length, self.buffer_size
+        while 1:
+            data = read(maxbuf if maxread < 0 else min(maxbuf, maxread))
+            if not data:
+                break
+            maxread -= len(data)
+            yield data
+
+    def _iterparse(self):
+        ''' Scan the buffered stream for the part delimiter and hand whole
+            slabs of body data to each part, instead of going line by line.
+        '''
+        chunks = self._chunkiter()
+        _bcrnl, _bdash = tob('\r\n'), tob('--')
+        delim = _bcrnl + _bdash + tob(self.boundary)
+        dlen = len(delim)
+        # Prefix a line break so that the first boundary looks like any other
+        # delimiter. Ignore leading blank lines
+        buf = _bcrnl
+        while 1:
+            pos = buf.find(delim)
+            if pos >= 0: break
+            data = next(chunks, None)
+            if not data or len(buf) > self.buffer_size + dlen:
+                raise MultipartError("Stream does not start with boundary")
+            buf += data
+        if buf[:pos].strip():
+            raise MultipartError("Stream does not start with boundary")
+        pos += dlen
+        while len(buf) - pos < 2:
+            data = next(chunks, None)
+            if not data:
+                raise MultipartError("Unexpected end of multipart stream.")
+            buf += data
+        if buf[pos:pos+1] == _bcrnl[1:]:
+            # Bare '\n' line endings, which only the line parser handles.
+            # Nothing has been trimmed off buf yet, so it can start over.
+            for part in self._line_fallback(buf[2:]):
+                yield part
+            return
+        # For each part in stream...
+        mem_used, disk_used = 0, 0 # Track used resources to prevent DoS
+        opts = {'buffer_size': self.buffer_size,
+                'memfile_limit': self.memfile_limit,
+                'charset': self.charset, 'sink': self.sink,
+                'spool_dir': self.spool_dir}
+        while 1:
+            # What follows a delimiter: '--' (the end) or a line break
+            while len(buf) - pos < 2:
+                data = next(chunks, None)
+                if not data:
+                    raise MultipartError("Unexpected end of multipart stream.")
+                buf, pos = buf[pos:] + data, 0
+            if buf[pos:pos+2] == _bdash:
+                break
+            if buf[pos:pos+2] != _bcrnl:
+                raise MultipartError("Syntax error in boundary line.")
+            pos += 2
+            part = MultipartPart(**opts)
+            # Header block, up to the first blank line
+            while 1:
+                if buf.startswith(_bcrnl, pos):
+                    end = pos
+                else:
+                    end = buf.find(_bcrnl + _bcrnl, pos)
+                if end >= 0: break
+                # Same bounds as reading the header line by line would have
+                line_start = max(pos, buf.rfind(_bcrnl, pos) + 2)
+                if len(buf) - line_start > self.buffer_size:
+                    raise MultipartError('Unexpected end of line in header.')
+                if len(buf) - pos > self.mem_limit:
+                    raise MultipartError("Memory limit reached.")
+                data = next(chunks, None)
+                if not data:
+                    raise MultipartError("Unexpected end of multipart stream.")
+                buf, pos = buf[pos:] + data, 0
+            if end > pos:
+                for line in buf[pos:end].split(_bcrnl):
+                    part.feed(line, _bcrnl)
+                end += 2
+            part.feed(_bcrnl[:0], _bcrnl)
+            pos = end + 2
+            # Body, up to the next delimiter
+            found = False
+            while not found:
+                end = buf.find(delim, pos)
+                found = end >= 0
+                if not found:
+                    # Hold back anything that could be a partial delimiter
+                    end = max(pos, len(buf) - dlen + 1)
+                part.write_data(buf[pos:end])
+                if part.is_buffered():
+                    if part.size + mem_used > self.mem_limit:
+                        raise MultipartError("Memory limit reached.")
+                elif part.on_disk() \
+                        and part.size + disk_used > self.disk_limit:
+                    raise MultipartError("Disk limit reached.")
+                if found:
+                    pos = end + dlen
+                else:
+                    data = next(chunks, None)
+                    if not data:
+                        raise MultipartError(
+                                "Unexpected end of multipart stream.")
+                    buf, pos = buf[end:] + data, 0
+            if part.is_buffered(): mem_used  += part.size
+            elif part.on_disk():   disk_used += part.size
+            part.rewind()
+            yield part
+
+
+    def _line_fallback(self, consumed):
+        ''' Parse the stream with LineMultipartParser instead, replaying the
+            :consumed bytes before reading on.
+        '''
+        parser = LineMultipartParser(_ReplayStream(consumed, self.stream),
+                self.boundary, self.content_length,
+                disk_limit=self.disk_limit, mem_limit=self.mem_limit,
+                memfile_limit=self.memfile_limit,
+                buffer_size=self.buffer_size, charset=self.charset,
+                sink=self.sink, spool_dir=self.spool_dir)
+        return parser._iterparse()
+
+
+class _ReplayStream(object):
+    ''' A stream that returns :prefix before reading on from :stream. '''
+    def __init__(self, prefix, stream):
+        self.prefix, self.stream = prefix, stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size < 0 or size >= len(self.prefix):
+            data, self.prefix = self.prefix, self.prefix[:0]
+        else:
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+
+class LineMultipartParser(MultipartParser):
+    ''' The original line-by-line parser. MultipartParser falls back to it
+        for streams with bare '\\n' line endings, and it is also the
+        benchmark baseline.
+    '''
+
     def _lineiter(self):
         ''' Iterate over a binary file-like object line by line. Each line is
             returned as a (line, line_ending) tuple. If the line does not fit
@@ -246,17 +463,18 @@ class MultipartParser(object):
         is_tail = False # True if the last line was incomplete (cutted)
         opts = {'buffer_size': self.buffer_size,
                 'memfile_limit': self.memfile_limit,
-                'charset': self.charset}
+                'charset': self.charset, 'sink': self.sink,
+                'spool_dir': self.spool_dir}
         part = MultipartPart(**opts)
         for line, nl in lines:
             if line == terminator and not is_tail:
-                part.file.seek(0)
+                part.rewind()
                 yield part
                 break
             elif line == separator and not is_tail:
                 if part.is_buffered(): mem_used  += part.size
-                else:                  disk_used += part.size
-                part.file.seek(0)
+                elif part.on_disk():   disk_used += part.size
+                part.rewind()
                 yield part
                 part = MultipartPart(**opts)
             else:
@@ -265,18 +483,26 @@ class MultipartParser(object):
                 if part.is_buffered():
                     if part.size + mem_used > self.mem_limit:
                         raise MultipartError("Memory limit reached.")
-                elif part.size + disk_used > self.disk_limit:
+                elif part.on_disk() \
+                        and part.size + disk_used > self.disk_limit:
                     raise MultipartError("Disk limit reached.")
         if line != terminator:
             raise MultipartError("Unexpected end of multipart stream.")
             
 
+
 class MultipartPart(object):
     
-    def __init__(self, buffer_size=2**16, memfile_limit=2**18, charset='latin1'):
+    def __init__(self, buffer_size=2**16, memfile_limit=2**18, charset='latin1',
+                 sink=None, spool_dir=None):
         self.headerlist = []
         self.headers = None
         self.file = False
+        self.path = None
+        self._own_file = True
+        self.sink = sink
+        self.spool_dir = spool_dir
+        self._mmap = None
         self.size = 0
         self._buf = tob('')
         self.disposition, self.name, self.filename = None, None, None
@@ -305,14 +531,20 @@ class MultipartPart(object):
 
     def write_body(self, line, nl):
         if not line and not nl: return # This does not even flush the buffer
-        self.size += len(line) + len(self._buf)
-        self.file.write(self._buf + line)
-        self._buf = nl
+        data, self._buf = self._buf + line, nl
+        self.write_data(data)
+
+    def write_data(self, data):
+        ''' Append a slab of body data, spooling to disk when needed. '''
+        if not data: return
+        self.size += len(data)
+        self.file.write(data)
         if self.content_length > 0 and self.size > self.content_length:
             raise MultipartError('Size of body exceeds Content-Length header.')
         if self.size > self.memfile_limit and isinstance(self.file, BytesIO):
             # TODO: What about non-file uploads that exceed the memfile_limit?
-            self.file, old = TemporaryFile(mode='w+b'), self.file
+            self.file, old = TemporaryFile(mode='w+b', dir=self.spool_dir), \
+                    self.file
             old.seek(0)
             copy_file(old, self.file, self.size, self.buffer_size)
 
@@ -330,11 +562,98 @@ class MultipartPart(object):
         self.content_type, options = parse_options_header(ctype)
         self.charset = options.get('charset') or self.charset
         self.content_length = int(self.headers.get('Content-Length','-1'))
+        if self.sink is not None:
+            self.set_target(self.sink(self))
+
+    def set_target(self, target):
+        ''' Send the body somewhere other than the default memory buffer:
+            a path (opened for writing), a writable file object or a callable
+            that is passed each chunk of data. None keeps the buffer.
+        '''
+        if target is None:
+            return
+        if isinstance(target, basestring):
+            self.path = target
+            target = open(target, 'w+b')
+        elif not hasattr(target, 'write'):
+            target = CallbackFile(target)
+        else:
+            # the sink's to close
+            self._own_file = False
+        self.file = target
+
+    def rewind(self):
+        ''' Seek the part's file back to the start, if that is possible. '''
+        seek = getattr(self.file, 'seek', None)
+        if seek is not None:
+            seek(0)
 
     def is_buffered(self):
         ''' Return true if the data is fully buffered in memory.'''
         return isinstance(self.file, BytesIO)
 
+    def on_disk(self):
+        ''' Return true if the data is written to a file, rather than kept in
+            memory or handed to a sink's callable. Only these count against
+            the parser's disk_limit.
+        '''
+        return not isinstance(self.file, (BytesIO, CallbackFile))
+
+    def mmap(self):
+        ''' A read-only memory map of a body that was spooled to disk (or
+            written to a sink's file). Searching, hashing or ``buffer()``-ing
+            it doesn't copy the data onto the heap, slicing copies just the
+            slice. The map is created once and stays valid until
+            :meth:`close`. Raises ValueError for bodies buffered in memory,
+            whose ``file.getvalue()`` can be used instead.
+        '''
+        if self._mmap is None:
+            if self.is_buffered() or not hasattr(self.file, 'fileno'):
+                raise ValueError('Part is not backed by a file.')
+            if not self.size:
+                raise ValueError('Cannot map an empty part.')
+            self.file.flush()
+            self._mmap = mmap.mmap(self.file.fileno(), self.size,
+                                   access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def view(self):
+        ''' A read-only view of the whole body: a ``memoryview`` (a
+            ``buffer`` on Python 2) of :meth:`mmap`, which doesn't copy, or
+            of a copy of the in-memory buffer, which is no bigger than
+            :attr:`memfile_limit`. Valid until :meth:`close`.
+        '''
+        if self.is_buffered():
+            data = self.file.getvalue()
+        elif not self.size:
+            data = tob('')
+        else:
+            data = self.mmap()
+        try:
+            return memoryview(data)
+        except TypeError: # pragma: no cover (Python 2 mmap)
+            return buffer(data)
+
+    def close(self):
+        ''' Release the memory map and close the file, unless it is a file
+            object that the sink supplied. A spooled body is deleted by this,
+            a file written to a path the sink gave is left on disk (see
+            :attr:`path`). Safe to call more than once; the part's data is
+            unavailable afterwards.
+        '''
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        close = getattr(self.file, 'close', None)
+        if close is not None and self._own_file:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     @property
     def value(self):
         ''' Data decoded with the specified charset '''
@@ -354,6 +673,111 @@ class MultipartPart(object):
             self.file.seek(pos)
         return size
 
+class CallbackFile(object):
+    ''' A write-only file that hands every chunk written to a callable. '''
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, data):
+        self.callback(data)
+
+    def read(self, size=-1):
+        return tob('')
+
+    def seek(self, offset, whence=0): pass
+    def tell(self): return 0
+
+
+def directory_sink(directory, fields=False):
+    ''' A sink that writes each file upload straight into :directory, named
+        after the basename of the client-supplied filename (made unique).
+        Other form fields are buffered unless :fields is true.
+    '''
+    def sink(part):
+        name = part.filename
+        if not name:
+            if not fields:
+                return None
+            name = part.name or 'field'
+        name = os.path.basename(name.replace('\\', '/')).lstrip('.') \
+                or 'upload'
+        base, ext = os.path.splitext(name)
+        path, counter = os.path.join(directory, name), 0
+        while 1:
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+            except OSError:
+                if not os.path.exists(path):
+                    raise
+                counter += 1
+                path = os.path.join(directory, '%s-%d%s' % (base, counter, ext))
+            else:
+                os.close(fd)
+                return path
+    return sink
+
+##############################################################################
+################################# Urlencoded #################################
+##############################################################################
+
+
+class UrlencodedParser(object):
+
+    def __init__(self, stream, content_length=-1, mem_limit=2**20,
+                 max_fields=1000, max_field_size=2**16, buffer_size=2**13):
+        ''' Parse an application/x-www-form-urlencoded byte stream
+            incrementally. This object is an iterator over the decoded
+            (name, value) byte string pairs; blank values are kept.
+
+            :param stream: A file-like stream. Must implement ``.read(size)``.
+            :param content_length: The maximum number of bytes to read.
+            :param mem_limit: Maximum size of the whole body.
+            :param max_fields: Maximum number of name/value pairs.
+            :param max_field_size: Maximum size of a single (encoded) pair.
+
+            Exceeding any of the limits raises :exc:`MultipartError` without
+            reading the rest of the stream.
+        '''
+        self.stream = stream
+        self.content_length = content_length
+        self.mem_limit = mem_limit
+        self.max_fields = max_fields
+        self.max_field_size = max_field_size
+        self.buffer_size = buffer_size
+        self.bytes_read = 0
+
+    def __iter__(self):
+        if self.content_length > self.mem_limit:
+            raise MultipartError("Request too big. Increase mem_limit.")
+        read = self.stream.read
+        maxread, maxbuf = self.content_length, self.buffer_size
+        _bamp, _bsemi = tob('&'), tob(';')
+        tail, fields = tob(''), 0
+        while 1:
+            data = read(maxbuf if maxread < 0 else min(maxbuf, maxread))
+            maxread -= len(data)
+            self.bytes_read += len(data)
+            if self.bytes_read > self.mem_limit:
+                raise MultipartError("Request too big. Increase mem_limit.")
+            pairs = (tail + data).replace(_bsemi, _bamp).split(_bamp)
+            # the last pair may continue in the next chunk
+            tail = pairs.pop() if data else tob('')
+            if len(tail) > self.max_field_size:
+                raise MultipartError("Form field too big.")
+            for pair in pairs:
+                if not pair:
+                    continue
+                if len(pair) > self.max_field_size:
+                    raise MultipartError("Form field too big.")
+                fields += 1
+                if fields > self.max_fields:
+                    raise MultipartError("Too many form fields.")
+                name, _, value = pair.partition(tob('='))
+                yield (unquote(name.replace(tob('+'), tob(' '))),
+                       unquote(value.replace(tob('+'), tob(' '))))
+            if not data:
+                break
+
 ##############################################################################
 #################################### WSGI ####################################
 ##############################################################################
@@ -396,15 +820,9 @@ def parse_form_data(environ, charset='utf8', strict=False, **kw):
         elif content_type in ('application/x-www-form-urlencoded',
                               'application/x-url-encoded'):
             mem_limit = kw.get('mem_limit', 2**20)
-            if content_length > mem_limit:
-                raise MultipartError("Request to big. Increase MAXMEM.")
-            data = stream.read(mem_limit).decode(charset)
-            if stream.read(1): # These is more that does not fit mem_limit
-                raise MultipartError("Request to big. Increase MAXMEM.")
-            data = parse_qs(data, keep_blank_values=True)
-            for key, values in data.iteritems():
-                for value in values:
-                    forms[key] = value
+            for key, value in UrlencodedParser(stream, content_length,
+                                               mem_limit=mem_limit):
+                forms[key.decode(charset)] = value.decode(charset)
         else:
             raise MultipartError("Unsupported content type.")
     except MultipartError:
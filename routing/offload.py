@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+
+import Queue
+import sys
+import threading
+import time
+
+
+__all__ = ["WorkerPool", "Saturated"]
+
+
+class Saturated(Exception):
+    "raised by WorkerPool.run when no more work can be queued"
+
+
+class _Job(object):
+    __slots__ = ['func', 'args', 'kwargs', 'queued', 'done', 'result',
+            'exc_info', 'cancelled']
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.queued = time.time()
+        self.done = threading.Event()
+        self.result = self.exc_info = None
+        self.cancelled = False
+
+
+class WorkerPool(object):
+    '''a fixed set of threads with a bounded queue in front of them
+
+    :param workers: number of threads, started on first use
+    :param queue_size: how many calls may wait for a free thread before
+        further calls are refused with `Saturated`, 0 to refuse them as soon
+        as every thread is busy
+    '''
+    def __init__(self, workers=4, queue_size=16):
+        if workers < 1 or queue_size < 0:
+            raise ValueError("need at least one worker and a queue_size >= 0")
+        self.workers = workers
+        self.queue_size = queue_size
+        # the bound is kept by counting pending calls instead, as Queue
+        # takes a maxsize of 0 to mean unbounded
+        self._queue = Queue.Queue()
+        self._pending = 0
+        self._threads = []
+        self._lock = threading.Lock()
+        self.busy = 0
+        self.started = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work,
+                        name="routing-pool-%d" % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while 1:
+            job = self._queue.get()
+            waited = time.time() - job.queued
+            with self._lock:
+                if job.cancelled:
+                    # its caller has given up on it and moved on
+                    self._pending -= 1
+                    continue
+                self.busy += 1
+                self.started += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            try:
+                job.result = job.func(*job.args, **job.kwargs)
+            except Exception:
+                job.exc_info = sys.exc_info()
+            with self._lock:
+                self.busy -= 1
+                self._pending -= 1
+                self.completed += 1
+            job.done.set()
+
+    def run(self, func, args=(), kwargs=None, timeout=None):
+        '''call func(*args, **kwargs) on a pool thread and wait for the result
+
+        raises `Saturated` straight away if the queue is full, or if the
+        result takes longer than `timeout` seconds. a call that times out
+        while still queued is dropped and never made, one already running is
+        left to finish. exceptions from `func` are re-raised here.
+
+        waiting with a timeout costs more than it seems: python 2 implements
+        it by polling, sleeping up to 50ms between checks, so results arrive
+        that much later than they would without one.
+        '''
+        if len(self._threads) < self.workers:
+            self._start()
+
+        job = _Job(func, args, kwargs or {})
+        with self._lock:
+            if self._pending >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise Saturated("worker pool queue is full")
+            self._pending += 1
+        self._queue.put(job)
+
+        if not job.done.wait(timeout):
+            with self._lock:
+                self.timed_out += 1
+                job.cancelled = True
+            raise Saturated("timed out waiting on the worker pool")
+
+        if job.exc_info is not None:
+            exc_type, exc_value, tb = job.exc_info
+            raise exc_type, exc_value, tb
+        return job.result
+
+    def stats(self):
+        started = self.started
+        return {
+            'workers': self.workers,
+            'busy': self.busy,
+            'queued': self._queue.qsize(),
+            'queue_size': self.queue_size,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'wait_avg': self.wait_total / started if started else 0.0,
+            'wait_max': self.wait_max,
+        }
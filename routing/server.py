@@ -0,0 +1,352 @@
+from __future__ import absolute_import
+
+import errno
+import multiprocessing
+import optparse
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from wsgiref import simple_server
+
+
+__all__ = ["PreforkServer", "serve"]
+
+
+class _ServerHandler(simple_server.ServerHandler):
+    # answers in HTTP/1.1 so that App.chunked's framed bodies go out as they
+    # are, where wsgiref refuses them. still one request per connection
+    http_version = '1.1'
+    chunked = unframe = False
+
+    def start_response(self, status, headers, exc_info=None):
+        # wsgiref won't take hop-by-hop headers, so hold back the one App sets
+        # and put it back in cleanup_headers
+        kept = [(k, v) for k, v in headers if k.lower() != 'transfer-encoding']
+        self.chunked = len(kept) < len(headers)
+        # clients older than HTTP/1.1 get the chunks undone instead, and the
+        # body ends when the connection is closed
+        self.unframe = self.chunked and self.environ.get(
+                'SERVER_PROTOCOL') in ('HTTP/0.9', 'HTTP/1.0')
+        self._framing, self._left, self._ended = '', 0, False
+        return simple_server.ServerHandler.start_response(
+                self, status, kept, exc_info)
+
+    def cleanup_headers(self):
+        if self.chunked:
+            if not self.unframe:
+                self.headers['Transfer-Encoding'] = 'chunked'
+        elif 'Content-Length' not in self.headers:
+            self.set_content_length()
+        self.headers['Connection'] = 'close'
+
+    def write(self, data):
+        if self.unframe:
+            data = self._unframe(data)
+        simple_server.ServerHandler.write(self, data)
+
+    def _unframe(self, data):
+        # the chunk data in `data`, keeping any partial size line for later
+        data = self._framing + data
+        body = []
+        while data and not self._ended:
+            if self._left:
+                piece = data[:self._left]
+                body.append(piece)
+                self._left -= len(piece)
+                data = data[len(piece):]
+                continue
+            line, sep, rest = data.partition('\r\n')
+            if not sep:
+                break
+            data = rest
+            # an empty line is the end of the previous chunk's data
+            if line:
+                self._left = int(line.split(';', 1)[0], 16)
+                self._ended = not self._left
+        self._framing = '' if self._ended else data
+        return ''.join(body)
+
+
+class _RequestHandler(simple_server.WSGIRequestHandler):
+    def handle(self):
+        # WSGIRequestHandler.handle, with the handler above
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+
+        handler = _ServerHandler(self.rfile, self.wfile, self.get_stderr(),
+                self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+class _WorkerServer(simple_server.WSGIServer):
+    # a WSGIServer on a socket it was handed rather than one it bound itself
+    requests = 0
+
+    def get_request(self):
+        conn, address = self.socket.accept()
+        # the listening socket is non-blocking, and on BSD and macOS accepted
+        # sockets inherit that
+        conn.setblocking(1)
+        return conn, address
+
+    def finish_request(self, request, client_address):
+        self.requests += 1
+        simple_server.WSGIServer.finish_request(self, request, client_address)
+
+    def handle_error(self, request, client_address):
+        traceback.print_exc()
+
+
+class PreforkServer(object):
+    '''serve a WSGI app from several forked worker processes
+
+    the app is loaded (and an App's route table frozen) in the parent before
+    forking, so workers start warm and share its memory copy-on-write. they
+    all accept from one listening socket opened by the parent, or with
+    `reuse_port` each gets its own SO_REUSEPORT socket and the kernel spreads
+    connections between them.
+
+    workers exit after `max_requests` requests (0 for never) and crashed ones
+    are restarted. SIGTERM and SIGINT stop the server, letting requests in
+    progress finish for up to `graceful_timeout` seconds. SIGHUP replaces the
+    workers the same way.
+
+    :param address: a (host, port) pair
+    :param app: the WSGI application
+    :param workers: number of processes, one per CPU by default
+    :param handler_class: the wsgiref request handler class to use. the
+        default one speaks HTTP/1.1, which App.chunked bodies (and so
+        App.sse and App.json streams) need
+    '''
+    def __init__(self, address, app, workers=None, max_requests=0,
+            reuse_port=False, backlog=128, graceful_timeout=30,
+            handler_class=_RequestHandler):
+        self.address = address
+        self.app = app
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.max_requests = max_requests
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.graceful_timeout = graceful_timeout
+        self.handler_class = handler_class
+        self.sockets = []
+        self.children = {} # pid -> (slot, started)
+        self._running = False
+        self._stopping = False
+
+    def listen(self):
+        '''open the listening socket(s), returns the bound address'''
+        count = self.workers if self.reuse_port else 1
+        address = self.address
+        for i in xrange(count):
+            sock = self._socket(address)
+            # later sockets join the first one, even if it picked the port
+            address = sock.getsockname()
+            self.sockets.append(sock)
+        return address
+
+    def _socket(self, address):
+        family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                raise ValueError("SO_REUSEPORT isn't available here")
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+        sock.listen(self.backlog)
+        # workers all wait on the socket, the ones that lose the race for a
+        # connection must not block in accept()
+        sock.setblocking(0)
+        return sock
+
+    def serve_forever(self):
+        freeze = getattr(self.app, 'freeze', None)
+        if freeze is not None:
+            freeze()
+        if not self.sockets:
+            self.listen()
+
+        self._running = True
+        handlers = {}
+        for signum, handler in ((signal.SIGTERM, self._on_stop),
+                (signal.SIGINT, self._on_stop), (signal.SIGHUP, self._on_hup)):
+            handlers[signum] = signal.signal(signum, handler)
+        try:
+            for slot in xrange(self.workers):
+                self._spawn(slot)
+            while self._running:
+                try:
+                    pid, status = os.waitpid(-1, 0)
+                except OSError, exc:
+                    if exc.errno == errno.EINTR:
+                        continue
+                    if exc.errno == errno.ECHILD:
+                        break
+                    raise
+                self._reap(pid, status)
+        finally:
+            for signum, handler in handlers.iteritems():
+                signal.signal(signum, handler)
+            self._shutdown()
+
+    def stop(self):
+        self._running = False
+
+    def _on_stop(self, signum, frame):
+        self._running = False
+
+    def _on_hup(self, signum, frame):
+        for pid in self.children:
+            self._kill(pid, signal.SIGTERM)
+
+    def _reap(self, pid, status):
+        child = self.children.pop(pid, None)
+        if child is None:
+            return
+        slot, started = child
+        if not self._running:
+            return
+        if status:
+            if os.WIFSIGNALED(status):
+                how = "was killed by signal %d" % os.WTERMSIG(status)
+            else:
+                how = "exited with code %d" % os.WEXITSTATUS(status)
+            sys.stderr.write("worker %d %s, restarting\n" % (pid, how))
+            # don't fork as fast as we can if workers die straight away
+            if time.time() - started < 1:
+                time.sleep(1)
+        self._spawn(slot)
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (slot, time.time())
+            return pid
+
+        status = 1
+        try:
+            self._work(slot)
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, exc:
+            if exc.errno != errno.ESRCH:
+                raise
+
+    def _shutdown(self):
+        for pid in self.children:
+            self._kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, exc:
+                if exc.errno == errno.ECHILD:
+                    break
+                if exc.errno != errno.EINTR:
+                    raise
+                continue
+            if pid:
+                self.children.pop(pid, None)
+            else:
+                time.sleep(0.05)
+        for pid in self.children:
+            self._kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.children.clear()
+        for sock in self.sockets:
+            sock.close()
+        del self.sockets[:]
+
+    def _work(self, slot):
+        # the worker side of a fork; it finishes the request it is on when
+        # told to stop, and the parent takes care of SIGINT
+        signal.signal(signal.SIGTERM, self._on_worker_stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self.children.clear()
+
+        if self.reuse_port:
+            sock = self.sockets[slot]
+            for other in self.sockets:
+                if other is not sock:
+                    other.close()
+        else:
+            sock = self.sockets[0]
+
+        server = _WorkerServer(self.address, self.handler_class,
+                bind_and_activate=False)
+        server.socket.close()
+        server.socket = sock
+        server.server_address = sock.getsockname()
+        host, port = server.server_address[:2]
+        server.server_name = socket.getfqdn(host)
+        server.server_port = port
+        server.setup_environ()
+        server.set_app(self.app)
+        # wake up now and then to notice being told to stop
+        server.timeout = 1
+
+        max_requests = self.max_requests
+        while not self._stopping:
+            if max_requests and server.requests >= max_requests:
+                break
+            server.handle_request()
+
+    def _on_worker_stop(self, signum, frame):
+        self._stopping = True
+
+
+def serve(address, app, **options):
+    '''serve `app` on `address` until stopped, see PreforkServer'''
+    PreforkServer(address, app, **options).serve_forever()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+            usage="python -m routing.server [options] module:app")
+    parser.add_option('-b', '--bind', default='127.0.0.1:8000',
+            help='host:port to listen on')
+    parser.add_option('-w', '--workers', type='int',
+            help='number of worker processes, one per CPU by default')
+    parser.add_option('--max-requests', type='int', default=0,
+            help='restart each worker after this many requests')
+    parser.add_option('--reuse-port', action='store_true',
+            help='give each worker its own SO_REUSEPORT socket')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1 or ':' not in args[0]:
+        parser.error("expected one module:app argument")
+
+    module, _, name = args[0].partition(':')
+    sys.path.insert(0, os.getcwd())
+    __import__(module)
+    app = getattr(sys.modules[module], name)
+
+    host, _, port = options.bind.rpartition(':')
+    serve((host.strip('[]'), int(port)), app, workers=options.workers,
+            max_requests=options.max_requests, reuse_port=options.reuse_port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+from __future__ import absolute_import
+
+import collections
+import itertools
+import threading
+import time
+
+
+__all__ = ["Event", "HEARTBEAT", "Broadcaster"]
+
+
+class Event(object):
+    '''one server-sent event, encoded for the wire once when it's created
+
+    `data` may span lines (and is utf8-encoded if unicode), `event` is the
+    event type, `id` what the client sends back as Last-Event-ID when it
+    reconnects, and `retry` its reconnection delay in milliseconds.
+    '''
+    __slots__ = ['data', 'event', 'id', 'encoded']
+
+    def __init__(self, data='', event=None, id=None, retry=None):
+        self.data = data
+        self.event = event
+        self.id = id
+
+        lines = []
+        if id is not None:
+            lines.append('id: %s' % _field(id))
+        if event is not None:
+            lines.append('event: %s' % _field(event))
+        if retry is not None:
+            lines.append('retry: %d' % retry)
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        if data or not lines:
+            data = data.replace('\r\n', '\n').replace('\r', '\n')
+            lines.extend('data: ' + line for line in data.split('\n'))
+        lines.append('\n')
+        self.encoded = '\n'.join(lines)
+
+    def __repr__(self):
+        return '<Event id=%r event=%r>' % (self.id, self.event)
+
+def _field(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    value = str(value)
+    if '\n' in value or '\r' in value:
+        raise ValueError("event ids and types can't contain line breaks")
+    return value
+
+
+class _Heartbeat(Event):
+    __slots__ = []
+
+    def __init__(self):
+        self.data = self.event = self.id = None
+        # a comment line, which clients ignore
+        self.encoded = ':\n\n'
+
+# yield this from an App.sse handler to keep an idle connection alive
+HEARTBEAT = _Heartbeat()
+
+
+class Broadcaster(object):
+    '''fan events out to any number of subscribed streams
+
+    each published event is encoded once and the same string is written to
+    every subscriber. the last `replay` events are kept so that a client
+    reconnecting with a Last-Event-ID gets what it missed. subscribers that
+    fall further behind than that skip ahead to the oldest event still kept.
+
+    with a `heartbeat` interval (in seconds), a background thread wakes every
+    subscriber that often so idle connections send a keepalive comment, and
+    ones whose client has gone away find out and are closed.
+    '''
+    def __init__(self, replay=1000, heartbeat=15):
+        self.replay = replay
+        self.heartbeat = heartbeat
+        self.subscribers = 0
+        self.closed = False
+        # (sequence number, event), oldest first
+        self._log = collections.deque(maxlen=max(replay, 1))
+        self._seq = 0
+        self._beats = 0
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._beater = None
+
+    def publish(self, data='', event=None, id=None, retry=None):
+        '''encode and send an event to every subscriber, returning it
+
+        events get consecutive numbers as their ids unless one is given
+        '''
+        if not isinstance(data, Event):
+            if id is None:
+                id = next(self._ids)
+            data = Event(data, event, id, retry)
+        with self._cond:
+            self._seq += 1
+            self._log.append((self._seq, data))
+            self._cond.notify_all()
+        return data
+
+    def beat(self):
+        '''have every subscriber send a heartbeat now'''
+        with self._cond:
+            self._beats += 1
+            self._cond.notify_all()
+
+    def close(self):
+        '''end every subscription, and stop the heartbeat thread'''
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def _start_beating(self):
+        # must hold the lock
+        if self._beater is not None or not self.heartbeat:
+            return
+        def run():
+            while not self.closed:
+                time.sleep(self.heartbeat)
+                self.beat()
+        self._beater = threading.Thread(target=run, name='sse-heartbeat')
+        self._beater.daemon = True
+        self._beater.start()
+
+    def _replay_from(self, last_event_id):
+        # must hold the lock. the sequence number to continue after
+        if last_event_id is None or not self.replay or not self._log:
+            return self._seq
+        last_event_id = str(last_event_id)
+        for seq, event in reversed(self._log):
+            if event.id is not None and str(event.id) == last_event_id:
+                return seq
+        # too old (or from before a restart): send everything kept
+        return self._log[0][0] - 1
+
+    def subscribe(self, last_event_id=None):
+        '''a generator of the events published from now on
+
+        with a `last_event_id`, the kept events after it are replayed first.
+        it yields HEARTBEAT whenever the broadcaster beats, and ends when it
+        is closed. meant to be returned from an App.sse handler, see
+        `stream` for one that reads Last-Event-ID itself.
+        '''
+        # the position is taken now rather than when iteration starts, so
+        # nothing published in between is missed
+        with self._cond:
+            seen = self._replay_from(last_event_id)
+            beats = self._beats
+            self._start_beating()
+        return self._follow(seen, beats)
+
+    def _follow(self, seen, beats):
+        with self._cond:
+            self.subscribers += 1
+        try:
+            while 1:
+                with self._cond:
+                    while (self._seq == seen and self._beats == beats
+                            and not self.closed):
+                        self._cond.wait()
+                    if self.closed:
+                        return
+                    if self._seq != seen:
+                        # usually just the newest event or two, so walk back
+                        events = []
+                        for seq, event in reversed(self._log):
+                            if seq <= seen:
+                                break
+                            events.append(event)
+                        events.reverse()
+                        seen = self._seq
+                    else:
+                        events = [HEARTBEAT]
+                    beats = self._beats
+                for event in events:
+                    yield event
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+
+    def stream(self, http):
+        '''subscribe, resuming from the request's Last-Event-ID'''
+        return self.subscribe(http.headers.get('Last-Event-ID'))
+
+    def stats(self):
+        return {
+            'subscribers': self.subscribers,
+            'published': self._seq,
+            'kept': len(self._log),
+        }
@@ -0,0 +1,148 @@
+from __future__ import absolute_import
+
+import functools
+import re
+import sre_constants
+import sre_parse
+import urllib
+import uuid
+
+
+__all__ = ["Converter", "CONVERTERS", "compile_pattern", "converting",
+        "url_template"]
+
+
+class Converter(object):
+    '''how a typed path segment like <int:id> is matched and converted
+
+    `regex` is what the segment matches, and should only match values that
+    `to_python` (None for leaving the string alone) can convert. `to_url`
+    turns a value back into URL text for App.url_for.
+    '''
+    __slots__ = ['regex', 'to_python', 'to_url']
+
+    def __init__(self, regex, to_python=None, to_url=None):
+        self.regex = regex
+        self.to_python = to_python
+        self.to_url = to_url or _quote_segment
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return str(value)
+
+def _quote_segment(value):
+    return urllib.quote(_utf8(value), safe='')
+
+def _quote_path(value):
+    return urllib.quote(_utf8(value), safe='/')
+
+def _int_url(value):
+    return str(int(value))
+
+
+# usable in any App's patterns, see App.converters for adding more
+CONVERTERS = {
+    'str': Converter(r'[^/]+'),
+    'int': Converter(r'\d+', int, _int_url),
+    'uuid': Converter(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+            r'[0-9a-fA-F]{4}-[0-9a-fA-F]{12}', uuid.UUID, str),
+    'path': Converter(r'.+', None, _quote_path),
+}
+
+# <name> or <converter:name>, but not the name in a (?P<name>...) group
+_SEGMENT = re.compile(r'(?<!\?P)<(?:(\w+):)?(\w+)>')
+
+
+def compile_pattern(pattern, converters=CONVERTERS):
+    '''translate the typed segments in a route pattern into named groups
+
+    returns the regex source, a {name: to_python} dict of the conversions to
+    apply to the match, and the pattern's pieces (literal regex text and
+    (name, converter) pairs, in order) for `url_template`
+    '''
+    source, conversions, pieces = [], {}, []
+    pos = 0
+    for match in _SEGMENT.finditer(pattern):
+        kind, name = match.group(1) or 'str', match.group(2)
+        converter = converters.get(kind)
+        if converter is None:
+            raise ValueError("unknown converter %r in %r" % (kind, pattern))
+        if any(name == piece[0] for piece in pieces if type(piece) is tuple):
+            raise ValueError("%r appears twice in %r" % (name, pattern))
+
+        literal = pattern[pos:match.start()]
+        source.append(literal)
+        source.append('(?P<%s>%s)' % (name, converter.regex))
+        pieces.append(literal)
+        pieces.append((name, converter))
+        if converter.to_python is not None:
+            conversions[name] = converter.to_python
+        pos = match.end()
+
+    source.append(pattern[pos:])
+    pieces.append(pattern[pos:])
+    return ''.join(source), conversions, pieces
+
+
+def converting(func, conversions):
+    '''wrap a handler so that its keyword arguments arrive converted'''
+    conversions = conversions.items()
+
+    @functools.wraps(func)
+    def inner(http, *args, **kwargs):
+        for name, convert in conversions:
+            value = kwargs.get(name)
+            if value is not None:
+                kwargs[name] = convert(value)
+        return func(http, *args, **kwargs)
+
+    return inner
+
+
+def url_template(pieces):
+    '''precompile a pattern's pieces (see `compile_pattern`) for url_for
+
+    returns a (format string, ((name, to_url), ...)) pair, or None when the
+    text between the typed segments isn't just literal (apart from leading
+    ^ and trailing $ anchors) and so can't be turned back into a URL
+    '''
+    parts, fields = [], []
+    last = len(pieces) - 1
+    for index, piece in enumerate(pieces):
+        if type(piece) is tuple:
+            name, converter = piece
+            parts.append('%s')
+            fields.append((name, converter.to_url))
+            continue
+        text = _literal_text(piece, index == 0, index == last)
+        if text is None:
+            return None
+        parts.append(text.replace('%', '%%'))
+    return ''.join(parts), tuple(fields)
+
+def _literal_text(source, first, last):
+    if not source:
+        return ''
+    try:
+        parsed = sre_parse.parse(source)
+    except (sre_constants.error, TypeError):
+        return None
+
+    to_char = unichr if isinstance(source, unicode) else chr
+    chars = []
+    items = list(parsed)
+    for position, (op, av) in enumerate(items):
+        if op is sre_constants.LITERAL:
+            chars.append(to_char(av))
+        elif op is sre_constants.AT and first and position == 0 and av in (
+                sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING):
+            continue
+        elif op is sre_constants.AT and last \
+                and position == len(items) - 1 and av in (
+                sre_constants.AT_END, sre_constants.AT_END_STRING):
+            continue
+        else:
+            return None
+    return ''.join(chars)